@@ -36,6 +36,10 @@ class TUI:
         self.id_for_target_urls = dict()
         self.all_queries_printout:str = ""
         self.seen:set = set()  # tracks target urls
+        self.scan_res:dict = dict()  # dashboard assembled from deltas
+        self.revision:int = 0  # of the dashboard, sent to get only the changes
+        self.etag:str = None  # of the last dashboard response
+        self.ws:aiohttp.ClientWebSocketResponse = None  # dashboard push channel
 
     async def __init_web_comm(self):
         self.port = int(config['port'])
@@ -53,24 +57,30 @@ class TUI:
             LOGGER.warning(f'Running in HTTP mode')
 
     async def loop(self):
-        while self.do_continue:
-            try:
-                if self.loop_stage == 'main':
-                    await self.main_menu()
-                elif self.loop_stage == 'open_browser':
-                    try:
-                        await self.open_url_in_browser()
-                    except KeyboardInterrupt:
-                        pass
-            except (KeyboardInterrupt, EOFError):
-                await self.session.close()
-                if boolinize(config['secure']): self.conn.close()
-                LOGGER.info('CLI terminated')
-                self.do_continue = False
-            except aiohttp.client_exceptions.ClientOSError:
-                LOGGER.warning('[Errno 104] Connection reset by peer')
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                LOGGER.warning('Server diconnected')
+        try:
+            while self.do_continue:
+                try:
+                    if self.loop_stage == 'main':
+                        await self.main_menu()
+                    elif self.loop_stage == 'open_browser':
+                        try:
+                            await self.open_url_in_browser()
+                        except KeyboardInterrupt:
+                            pass
+                except (KeyboardInterrupt, EOFError):
+                    LOGGER.info('CLI terminated')
+                    self.do_continue = False
+                except aiohttp.client_exceptions.ClientOSError:
+                    LOGGER.warning('[Errno 104] Connection reset by peer')
+                except aiohttp.client_exceptions.ServerDisconnectedError:
+                    LOGGER.warning('Server diconnected')
+        finally:
+            if not self.do_continue: await self.close()
+
+    async def close(self):
+        if self.ws is not None: await self.ws.close()
+        await self.session.close()
+        if boolinize(config['secure']): self.conn.close()
 
     async def get_request(self, route:str, data:dict) -> dict:
         start_ = monotonic()
@@ -98,6 +108,25 @@ class TUI:
         LOGGER.debug(f"[POST] <{route}> in {(monotonic()-start_)*1000:.2f}ms content: {res}")
         return res
 
+    async def poll_dashboard(self) -> dict:
+        '''returns changes of the dashboard or None if it was not modified since the last poll'''
+        start_ = monotonic()
+        res = dict()
+        headers = {'If-None-Match': self.etag} if self.etag else None
+        try:
+            resp = await self.session.post(f"{self.address}/get_dashboard_delta", json=dict(revision=self.revision, **self.auth_session), headers=headers)
+            if resp.status in {304, 412}:  # the server answers a matching POST with 412
+                LOGGER.debug(f"[POST] <get_dashboard_delta> in {(monotonic()-start_)*1000:.2f}ms not modified")
+                return None
+            self.etag = resp.headers.get('ETag')
+            res = await resp.json()
+        except requests.exceptions.ConnectionError:
+            LOGGER.warning('Internet Connection Lost!', 'ERROR')
+        except aiohttp.client_exceptions.ContentTypeError as e:
+            LOGGER.error(e, 'ERROR')
+        LOGGER.debug(f"[POST] <get_dashboard_delta> in {(monotonic()-start_)*1000:.2f}ms content: {res}")
+        return res
+
     async def login_form(self):
         system(self.clear_cmd)
         if boolinize(config['auto_login']):
@@ -165,25 +194,63 @@ class TUI:
     async def scan_menu(self):
         system(self.clear_cmd)
         self.loop_stage = 'open_browser'
+        self.revision, self.etag = 0, None  # start with the full dashboard
+        if boolinize(config['push']) and await self.watch_dashboard():
+            return
         while True:
             try:
-                # if no queries were run, endpoint returns an empty dict
-                self.scan_res = await self.post_request('get_dashboard', data=self.auth_session)
-                system(self.clear_cmd)
-                if boolinize(self.scan_res.get('success', True)):
-                    print(await self.dashboard_printout(self.scan_res), end='')
-                    if self.unnotified_new:
-                        await self.play_sound(self.unnotified_new)
-                        self.unnotified_new = ''
-                    sleep(self.refresh_interval)
-                else:
-                    print(self.scan_res.get('msg', 'Connection Error'))
-                    input('Press any key to continue...')
-                    self.loop_stage = 'main'
-                    break
+                res = await self.poll_dashboard()
+                if res is not None and not await self.show_dashboard(res): break
+                sleep(self.refresh_interval)
             except KeyboardInterrupt:
                 break
 
+    async def watch_dashboard(self) -> bool:
+        '''print the dashboard whenever the server pushes changes.
+           Returns False if the push channel is not available, so that the dashboard is polled instead'''
+        if self.ws is not None: await self.ws.close()
+        try:
+            self.ws = await self.session.ws_connect(f"{self.address}/subscribe")
+            await self.ws.send_json(dict(revision=self.revision, **self.auth_session))
+        except aiohttp.ClientError as e:
+            LOGGER.warning(f'Push channel unavailable, polling the dashboard instead: {e}')
+            return False
+        try:
+            async for msg in self.ws:
+                if msg.type != aiohttp.WSMsgType.TEXT: break
+                if not await self.show_dashboard(msg.json()): return True
+        except KeyboardInterrupt:
+            return True  # back to the menu, like the polling loop
+        finally:
+            await self.ws.close()
+            self.ws = None
+        LOGGER.warning('Push channel closed, polling the dashboard instead')
+        return False
+
+    async def show_dashboard(self, res:dict) -> bool:
+        '''print the dashboard updated with the delta. Returns False on error'''
+        system(self.clear_cmd)
+        if not boolinize(res.get('success', True)):
+            print(res.get('msg', 'Connection Error'))
+            input('Press any key to continue...')
+            self.loop_stage = 'main'
+            return False
+        self.apply_delta(res)
+        print(await self.dashboard_printout(self.scan_res), end='')
+        if self.unnotified_new:
+            await self.play_sound(self.unnotified_new)
+            self.unnotified_new = ''
+        return True
+
+    def apply_delta(self, delta:dict):
+        '''update the dashboard with queries changed since the last revision'''
+        if 'revision' not in delta: return  # connection error
+        if delta['full']: self.scan_res = dict()
+        self.scan_res.update(delta['queries'])
+        for uid in delta['removed']:
+            self.scan_res.pop(uid, None)
+        self.revision = delta['revision']
+
     async def play_sound(self, filename:str=''):
         # ask server for a new file if not exists in cache
         if not filename in listdir(f"{CWD}/cache"):
@@ -245,10 +312,17 @@ class TUI:
             alert_sound = input('*Alert Sound: ')
             min_matches = input('*Min Matches: ') or 1
             cooldown = input('*Cooldown: ') or 0
+            parser = input('*Parser: ') or None
+            connect_timeout = input('*Connect Timeout: ') or None
+            read_timeout = input('*Read Timeout: ') or None
+            adaptive = input('*Adaptive: ') or False
+            max_interval = input('*Max Interval: ') or None
             q = dict(url=url_, sequence=seq, interval=interval, randomize=randomize, eta=eta, 
                      mode=mode, cycles_limit=cycles_limit, is_recurring=is_recurring, 
                      cookies_filename=cookies_basename, alias=alias, alert_sound=alert_sound, 
-                     target_url=target_url, min_matches=min_matches, cooldown=cooldown)
+                     target_url=target_url, min_matches=min_matches, cooldown=cooldown, parser=parser,
+                     connect_timeout=connect_timeout, read_timeout=read_timeout, adaptive=adaptive,
+                     max_interval=max_interval)
             q.update(self.auth_session)
             res = await self.post_request('add_query', data=q)
             print(res['msg'])
@@ -264,7 +338,7 @@ class TUI:
             c = int(v['cycles_limit'])
             if c: continue
             match = await self.get_notification_sign(boolinize(v['found']), v['alert_sound'], v['is_new'], v['target_url'], boolinize(v['is_recurring']))
-            msg = QSTAT_CODES[int(v['status'])]
+            msg = v.get('host_status') or QSTAT_CODES[int(v['status'])]
             if c > 0: cycles_indicator = f"{v['cycles']:>3}/{v['cycles_limit']:<4}"
             elif c < 0: cycles_indicator = '  -/-   ' 
             else: cycles_indicator = f"{v['cycles']:^8}"
@@ -351,10 +425,17 @@ class TUI:
         min_matches = rlinput('min_matches: ', prefill=data['min_matches']) or 1
         last_run = rlinput('last_run: ', prefill=data['last_run']) or 0
         cooldown = rlinput('cooldown: ', prefill=data['cooldown']) or 0
+        parser = rlinput('parser: ', prefill=data['parser']) or None
+        connect_timeout = rlinput('connect_timeout: ', prefill=data['connect_timeout'] or '') or None
+        read_timeout = rlinput('read_timeout: ', prefill=data['read_timeout'] or '') or None
+        adaptive = rlinput('adaptive: ', prefill=data['adaptive']) or False
+        max_interval = rlinput('max_interval: ', prefill=data['max_interval']) or None
         q = dict(uid=data['uid'], url=url, sequence=sequence, interval=interval, randomize=randomize, eta=eta, 
                     mode=mode, cycles=data['cycles'], cycles_limit=cycles_limit, is_recurring=is_recurring,
                     last_run=last_run, found=found, cookies_filename=data['cookies_filename'], alias=alias, 
-                    alert_sound=alert_sound, target_url=target_url, min_matches=min_matches, cooldown=cooldown
+                    alert_sound=alert_sound, target_url=target_url, min_matches=min_matches, cooldown=cooldown,
+                    parser=parser, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                    adaptive=adaptive, max_interval=max_interval
                  )
         q.update(self.auth_session)
         res = await self.post_request('edit_query', data=q)
@@ -400,8 +481,11 @@ if __name__ == '__main__':
     loop = asyncio.new_event_loop()
     loop.run_until_complete(tui.init())
     while tui.do_continue:
+        task = loop.create_task(tui.loop())
         try:
-            loop.run_until_complete(tui.loop())
+            loop.run_until_complete(task)
         except KeyboardInterrupt:
-            pass
+            # interrupted while waiting on the event loop, e.g. for the push channel - let the task clean up
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
 
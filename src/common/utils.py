@@ -4,6 +4,7 @@ QSTAT_CODES = {
     0: 'OK',
     1: 'Access Denied',
     2: 'Connection Lost',
+    3: 'Timed Out',
 }
 
 __true_values = {'true','yes','1','on', True}
@@ -0,0 +1,96 @@
+import json
+import logging
+import zlib
+from aiohttp import web
+from server import config
+
+LOGGER = logging.getLogger('Codec')
+
+# orjson is optional, the standard json module is used without it
+try:
+    import orjson
+    ORJSON = True
+except ImportError:
+    ORJSON = False
+
+# Responses are compressed with the first encoding accepted by the client
+COMPRESSORS = dict()
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+if brotli: COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=5)
+COMPRESSORS['gzip'] = lambda body: _gzip(body)
+
+_warned = False
+
+
+def _use_orjson() -> bool:
+    global _warned
+    if config['json_codec'] != 'orjson': return False
+    if not ORJSON and not _warned:
+        LOGGER.warning('json_codec is set to orjson, but it is not installed. Using json')
+        _warned = True
+    return ORJSON
+
+
+def loads(body:bytes):
+    '''raises ValueError if the body is not valid JSON'''
+    return orjson.loads(body) if _use_orjson() else json.loads(body)
+
+
+def dumps(obj) -> str:
+    if _use_orjson():
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+
+def json_response(data, **kwargs) -> web.Response:
+    '''web.json_response encoded with the configured codec'''
+    if _use_orjson():
+        return web.Response(body=orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), content_type='application/json', **kwargs)
+    return web.json_response(data, **kwargs)
+
+
+def _gzip(body:bytes) -> bytes:
+    obj = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return obj.compress(body) + obj.flush()
+
+
+def _accepted_encodings(header:str) -> set[str]:
+    res = set()
+    for e in header.split(','):
+        coding, _, params = e.strip().partition(';')
+        if params.replace(' ', '') not in {'q=0', 'q=0.0', 'q=0.00', 'q=0.000'}:
+            res.add(coding.strip().lower())
+    return res
+
+
+@web.middleware
+async def compression_middleware(request:web.Request, handler):
+    '''Compresses JSON responses larger than compress_min_size with an encoding accepted by the client'''
+    resp = await handler(request)
+    if not isinstance(resp, web.Response) or resp.content_type != 'application/json' or 'Content-Encoding' in resp.headers:
+        return resp
+    body = resp.body
+    if not isinstance(body, bytes) or len(body) < int(config['compress_min_size']):
+        return resp
+    resp.headers['Vary'] = 'Accept-Encoding'
+    accepted = _accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for coding, compress in COMPRESSORS.items():
+        if coding in accepted:
+            resp.body = compress(body)
+            resp.headers['Content-Encoding'] = coding
+            etag = resp.headers.get('ETag')
+            if etag: resp.headers['ETag'] = f'{etag[:-1]}-{coding}"'  # strong ETags differ per encoding
+            break
+    return resp
+
+
+def etag_matches(request:web.Request, etag:str) -> bool:
+    '''True if the client already has the representation with the ETag, in any encoding'''
+    tags = {t.strip() for t in request.headers.get('If-None-Match', '').split(',')}
+    return etag in tags or any(f'{etag[:-1]}-{coding}"' in tags for coding in COMPRESSORS)
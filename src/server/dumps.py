@@ -0,0 +1,153 @@
+import os
+import re
+import hashlib
+import logging
+import lz4.frame
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from server.utils import singleton
+from server import config, CWD
+
+LOGGER = logging.getLogger('PageDump')
+PAGEDUMP = os.path.realpath(f'{CWD}/../../page_dump')
+ALLOWED_CHARS = 'qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM_1234567890'
+
+
+def dump_name(url:str) -> str:
+    return '_'.join(re.split(rf'[^{ALLOWED_CHARS}]+', url))
+
+
+@singleton
+class PageDumper:
+    '''Writes page dumps in the background. Pages are stored lz4-compressed under their digest,
+       so identical pages are stored once and removed once no index refers to them.
+       Each url keeps an index of its last dumps:
+       page_dump/<url>.idx - "<datetime> <digest>" per line
+       page_dump/objects/<digest>.lz4'''
+
+    def __init__(self, path:str=PAGEDUMP):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.history = int(config['dump_history'])
+        self.max_size = int(config['dump_max_size'])
+        self.pending = threading.BoundedSemaphore(int(config['dump_max_pending']))  # Queries submit from worker threads
+        self.size = None  # total size of the objects, computed on the first write
+        self.refs = None  # digest: number of index entries referring to the object, counted on the first write
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PageDump')
+
+    def submit(self, url:str, content:str):
+        '''Queue the page to be written. Dumps are dropped if the writer falls behind'''
+        if not self.pending.acquire(blocking=False):
+            LOGGER.warning(f'Page dump queue is full, skipping {url}')
+            return
+        self.executor.submit(self._write, url, content, datetime.now())
+
+    def _write(self, url:str, content:str, dt:datetime):
+        try:
+            data = content.encode()
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            os.makedirs(self.objects, exist_ok=True)
+            if self.size is None: self.size, self.refs = self._get_size(), self._get_refs()
+            obj = os.path.join(self.objects, f'{digest}.lz4')
+            if os.path.exists(obj):
+                os.utime(obj)  # keep it from being rotated out
+            else:
+                with open(obj, 'wb') as f:
+                    f.write(lz4.frame.compress(data))
+                self.size += os.path.getsize(obj)
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            for trimmed in self._append_index(dump_name(url), f'{dt.isoformat()} {digest}'):
+                self._release(trimmed)
+            if self.size > self.max_size: self._rotate()
+            LOGGER.debug(f"Dumped content of a page {url}")
+        except Exception as e:
+            LOGGER.error(f'Failed to dump content of a page {url}: {e}')
+        finally:
+            self.pending.release()
+
+    def _append_index(self, name:str, entry:str) -> list[str]:
+        '''keep only the last dump_history entries. Returns digests of the trimmed entries'''
+        index = os.path.join(self.path, f'{name}.idx')
+        try:
+            with open(index, 'r') as f:
+                entries = f.read().splitlines()
+        except FileNotFoundError:
+            entries = []
+        entries.append(entry)
+        trimmed, entries = entries[:-self.history], entries[-self.history:]
+        with open(index, 'w') as f:
+            f.write('\n'.join(entries) + '\n')
+        return [e.split()[-1] for e in trimmed]
+
+    def _release(self, digest:str):
+        '''remove the object once no index refers to it'''
+        self.refs[digest] = self.refs.get(digest, 1) - 1
+        if self.refs[digest] <= 0:
+            del self.refs[digest]
+            obj = os.path.join(self.objects, f'{digest}.lz4')
+            try:
+                self.size -= os.path.getsize(obj)
+                os.remove(obj)
+            except FileNotFoundError:
+                pass
+
+    def _get_size(self) -> int:
+        return sum(e.stat().st_size for e in os.scandir(self.objects) if e.is_file())
+
+    def _get_refs(self) -> dict:
+        refs = dict()
+        for e in os.scandir(self.path):
+            if e.name.endswith('.idx'):
+                with open(e.path, 'r') as f:
+                    for line in f.read().splitlines():
+                        digest = line.split()[-1]
+                        refs[digest] = refs.get(digest, 0) + 1
+        return refs
+
+    def _rotate(self):
+        '''remove the least recently dumped pages until the total size fits in dump_max_size,
+           along with the index entries referring to them'''
+        objects = sorted((e for e in os.scandir(self.objects) if e.is_file()), key=lambda e: e.stat().st_mtime)
+        self.size = sum(e.stat().st_size for e in objects)
+        removed = set()
+        for e in objects:
+            if self.size <= self.max_size: break
+            self.size -= e.stat().st_size
+            os.remove(e.path)
+            removed.add(e.name[:-len('.lz4')])
+        for digest in removed:
+            self.refs.pop(digest, None)
+        for e in os.scandir(self.path):
+            if e.name.endswith('.idx'):
+                self._drop_entries(e.path, removed)
+        LOGGER.info(f'Rotated page dumps, current size: {self.size} bytes')
+
+    def _drop_entries(self, index:str, digests:set):
+        with open(index, 'r') as f:
+            entries = f.read().splitlines()
+        kept = [e for e in entries if e.split()[-1] not in digests]
+        if not kept:
+            os.remove(index)
+        elif len(kept) < len(entries):
+            with open(index, 'w') as f:
+                f.write('\n'.join(kept) + '\n')
+
+    def load(self, url:str, n:int=-1) -> str:
+        '''returns the n-th dump of the url from the index, the latest by default.
+           Returns None if the dump does not exist or was rotated out'''
+        try:
+            with open(os.path.join(self.path, f'{dump_name(url)}.idx'), 'r') as f:
+                digest = f.read().splitlines()[n].split()[-1]
+            with open(os.path.join(self.objects, f'{digest}.lz4'), 'rb') as f:
+                return lz4.frame.decompress(f.read()).decode()
+        except (FileNotFoundError, IndexError):
+            LOGGER.warning(f'Page dump {n} of {url} is not available')
+            return None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        LOGGER.info('Page dump writer shut down')
+
+
+page_dumper = PageDumper()
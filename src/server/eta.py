@@ -0,0 +1,68 @@
+from datetime import datetime, date, time, timedelta
+
+DAY = timedelta(days=1)
+
+
+class Eta(dict):
+    '''Parsed ETA rules compiled for evaluation. Compares equal to the plain rules dict.
+       Rules of the same kind are alternatives, rules of different kinds must all be met'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dow = frozenset(self.get('dow', []))
+        self.dow_span = tuple(self.get('dow_span', []))
+        self.time_span = tuple(self.get('time_span', []))
+        self.dt = frozenset(self.get('dt', []))
+        self.dt_span = tuple((s, e+DAY) for s, e in self.get('dt_span', []))
+        self.dates = sorted(self._to_date(d) for d in self.dt if self._to_date(d))
+        self.date_spans = sorted((s.date(), e.date()) for s, e in self.get('dt_span', []))
+
+    def _to_date(self, dt:tuple) -> date:
+        try:
+            return date(dt[2], dt[1], dt[0])
+        except ValueError:
+            return None
+
+    def is_open(self, n:datetime) -> bool:
+        '''checks if all ETA rules are satisfied at the given time'''
+        if self.time_span and not any(s <= (n.hour, n.minute) <= e for s, e in self.time_span): return False
+        if self.dt_span and not any(s <= n <= e for s, e in self.dt_span): return False
+        return self._is_open_day(n.date())
+
+    def _is_open_day(self, d:date) -> bool:
+        '''checks date-level rules only'''
+        if self.dow and d.weekday() not in self.dow: return False
+        if self.dt_span and not any(s <= d <= e for s, e in self.date_spans): return False
+        if self.dow_span and not any(s <= d.weekday() <= e for s, e in self.dow_span): return False
+        if self.dt and (d.day, d.month, d.year) not in self.dt: return False
+        return True
+
+    def next_window(self, n:datetime) -> datetime:
+        '''returns the earliest time, not before n, at which the ETA is satisfied or None if it never will be'''
+        if self.is_open(n): return n
+        first, last = n.date(), n.date()+7*DAY  # without dates, rules repeat weekly
+        if self.dt:
+            if not self.dates: return None
+            first, last = max(first, self.dates[0]), self.dates[-1]
+        if self.dt_span:
+            first = max(first, self.date_spans[0][0])
+            last = min(last, max(e for _, e in self.date_spans)) if self.dt else max(e for _, e in self.date_spans)
+        d = first
+        while d <= last:
+            if self._is_open_day(d):
+                t = self._first_open_time(d, n.time() if d == n.date() else time())
+                if t: return t
+            d += DAY
+        return None
+
+    def _first_open_time(self, d:date, start:time) -> datetime:
+        '''returns the first minute of the day, not before start, that fits in any time_span'''
+        if not self.time_span: return datetime.combine(d, start)
+        start = (start.hour, start.minute)
+        candidates = [max(start, s) for s, e in self.time_span if max(start, s) <= e and max(start, s) < (24, 0)]
+        if not candidates: return None
+        return datetime.combine(d, time(*min(candidates)))
+
+
+def compile_eta(eta:dict) -> Eta:
+    return eta if isinstance(eta, Eta) else Eta(eta)
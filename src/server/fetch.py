@@ -0,0 +1,343 @@
+import aiohttp
+from aiohttp.abc import AbstractResolver
+import asyncio
+import codecs
+import hashlib
+import logging
+import socket
+import zlib
+from time import monotonic
+from urllib.parse import urlsplit
+from typing import AsyncIterator, Awaitable, Callable
+from server import config
+from server.http2 import Http2Client
+from common.utils import boolinize
+
+LOGGER = logging.getLogger('Fetch')
+CHUNK_SIZE = 2**16
+
+# Body is decompressed by the Fetcher, so that every encoding is streamed the same way
+DECOMPRESSORS = {
+    'deflate': lambda: ZlibDecompressor(zlib.MAX_WBITS),
+    'gzip': lambda: ZlibDecompressor(16+zlib.MAX_WBITS),
+}
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+if brotli: DECOMPRESSORS['br'] = lambda: SlicedDecompressor(BrotliDecompressor())
+try:
+    import zstandard
+    DECOMPRESSORS['zstd'] = lambda: SlicedDecompressor(zstandard.ZstdDecompressor().decompressobj())
+except ImportError:
+    pass
+ACCEPT_ENCODING = ', '.join(reversed(DECOMPRESSORS))  # strongest first
+
+
+class ZlibDecompressor:
+    '''Incremental gzip/deflate decompression. Accepts raw deflate streams sent without the zlib header'''
+
+    def __init__(self, wbits:int):
+        self.obj = zlib.decompressobj(wbits)
+        self.started = False
+
+    def decompress(self, data:bytes, max_length:int=0) -> bytes:
+        if not self.started and data:
+            self.started = True
+            try:
+                return self.obj.decompress(data, max_length)
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.obj.decompress(data, max_length)
+
+    def flush(self) -> bytes:
+        return self.obj.flush()
+
+
+class BrotliDecompressor:
+    '''Incremental brotli decompression, compatible with both brotli and brotlicffi'''
+
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+        self.decompress = getattr(self.obj, 'process', None) or self.obj.decompress
+
+    def flush(self) -> bytes:
+        return b''
+
+
+class SlicedDecompressor:
+    '''Output limit for decompressors that don't support one. The input is fed in small slices,
+       so that at most one slice is decompressed past the limit'''
+    SLICE = 256
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def decompress(self, data:bytes, max_length:int=0) -> bytes:
+        out, size = [], 0
+        for i in range(0, len(data), self.SLICE):
+            out.append(self.obj.decompress(data[i:i+self.SLICE]))
+            size += len(out[-1])
+            if max_length and size >= max_length: break
+        return b''.join(out)[:max_length or None]
+
+    def flush(self) -> bytes:
+        return self.obj.flush()
+
+
+class IdentityDecompressor:
+
+    def decompress(self, data:bytes, max_length:int=0) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def get_decompressor(encoding:str):
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return IdentityDecompressor()
+    try:
+        return DECOMPRESSORS[encoding]()
+    except KeyError:
+        raise aiohttp.ClientPayloadError(f'Unsupported Content-Encoding: {encoding}')
+
+
+class Page:
+    '''Response to a page request'''
+
+    def __init__(self, status:int, headers:dict, text:str='', digest:bytes=b'', complete:bool=True):
+        self.status = status
+        self.headers = headers
+        self.text = text
+        self.digest = digest  # fingerprint of the raw body
+        self.complete = complete  # False if the body was truncated or not read until the end
+        self.parsed = dict()  # text prepared for matching, by parser. Shared by all Queries receiving the page
+
+    def __repr__(self):
+        return f"Page(status={self.status}, length={len(self.text)})"
+
+
+class CachingResolver(AbstractResolver):
+    '''Keeps resolved addresses for dns_cache_ttl seconds, so that hosts can be resolved ahead of time'''
+
+    def __init__(self):
+        self.resolver = aiohttp.DefaultResolver()
+        self.cache = dict()  # (host, port, family): (expires, addresses)
+        self.in_flight = dict()  # (host, port, family): asyncio.Task
+
+    async def resolve(self, host:str, port:int=0, family:int=socket.AF_INET) -> list:
+        key = (host, port, family)
+        try:
+            expires, addrs = self.cache[key]
+            if expires > monotonic(): return addrs
+        except KeyError:
+            pass
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(self.resolver.resolve(host, port, family))
+        try:
+            addrs = await asyncio.shield(self.in_flight[key])
+        finally:
+            self.in_flight.pop(key, None)
+        self.cache[key] = (monotonic() + float(config['dns_cache_ttl']), addrs)
+        return addrs
+
+    async def close(self):
+        self.cache.clear()
+        await self.resolver.close()
+
+
+class Fetcher:
+    '''Shares one aiohttp.ClientSession between all Queries of all users.
+       Concurrent requests for the same url, cookies and headers are coalesced into one
+       download and responses are cached for fetch_cache_ttl seconds'''
+
+    def __init__(self):
+        self.session:aiohttp.ClientSession = None
+        self.in_flight:dict[tuple, asyncio.Task] = dict()
+        self.cache:dict[tuple, tuple[float, Page]] = dict()
+        self.next_sweep = 0
+        self.stats = dict(downloads=0, coalesced=0, cached=0, received_bytes=0, body_bytes=0)
+        self.resolver:CachingResolver = None
+        self.warmed = dict()  # origin: time of the last connection pre-warm
+        self.http2 = Http2Client()
+
+    async def close(self):
+        '''Called on server shutdown'''
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            LOGGER.info('Closed shared ClientSession')
+        await self.http2.close()
+        if self.resolver is not None:
+            await self.resolver.close()
+        self.session, self.resolver = None, None
+        self.cache.clear()
+        self.warmed.clear()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        '''Create the session lazily, as it must be bound to the running event loop'''
+        if self.session is None or self.session.closed:
+            self.resolver = CachingResolver()
+            connector = aiohttp.TCPConnector(
+                resolver=self.resolver,
+                use_dns_cache=False,  # cached by the resolver
+                limit=int(config['fetch_limit']),
+                limit_per_host=int(config['fetch_limit_per_host']),
+                keepalive_timeout=float(config['fetch_keepalive']),
+            )
+            timeout = aiohttp.ClientTimeout(sock_connect=float(config['connect_timeout']), sock_read=float(config['read_timeout']))
+            # Cookies are passed per request, so the jar must not leak them between Queries
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar(),
+                                                 headers={'Accept-Encoding': ACCEPT_ENCODING}, auto_decompress=False)
+            LOGGER.info('Created shared ClientSession')
+        return self.session
+
+    async def get(self, url:str, cookies:dict=None, headers:dict=None, timeout:aiohttp.ClientTimeout=None, consume:Callable[[str, bool], Awaitable[bool]]=None) -> Page:
+        '''returns the page with decoded body. Body is empty if the page was not modified.
+           If consume is given, the decoded body is passed to it in chunks instead
+           and reading stops as soon as it returns True'''
+        key = (url, frozenset((cookies or {}).items()), frozenset((headers or {}).items()))
+        page = self._get_cached(key)
+        if page is None and key in self.in_flight:
+            self.stats['coalesced'] += 1
+            page = await asyncio.shield(self.in_flight[key])
+        if page is not None:
+            if consume is not None and page.status != 304:
+                await consume(page.text, True)
+            return page
+        if consume is not None:
+            # a streamed body may be left unread, so it can't be shared
+            self.stats['downloads'] += 1
+            return await self._download(url, cookies, headers, timeout, consume)
+        task = asyncio.ensure_future(self._download(url, cookies, headers, timeout))
+        task.add_done_callback(lambda t: self._settle(key, t))
+        self.in_flight[key] = task
+        self.stats['downloads'] += 1
+        # followers must not be cancelled along with the Query that started the download
+        return await asyncio.shield(task)
+
+    async def prewarm(self, urls:set):
+        '''Resolve hosts of the urls and, if prewarm_connections is enabled, open connections
+           to them ahead of the requests. Failures are left for the actual request to report'''
+        session = self._get_session()
+        warm_connections = boolinize(config['prewarm_connections'])
+        keepalive = float(config['fetch_keepalive'])
+        tasks = dict()
+        for url in urls:
+            try:
+                u = urlsplit(url)
+                origin = f'{u.scheme}://{u.netloc}'
+                if origin in tasks:
+                    continue
+                if warm_connections and monotonic() - self.warmed.get(origin, -keepalive) >= keepalive:
+                    self.warmed[origin] = monotonic()
+                    tasks[origin] = self._open_connection(session, origin)
+                else:
+                    port = u.port or (443 if u.scheme == 'https' else 80)
+                    if (u.hostname, port) not in tasks:
+                        tasks[(u.hostname, port)] = self.resolver.resolve(u.hostname, port, socket.AF_UNSPEC)
+            except (ValueError, TypeError):
+                continue
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        LOGGER.debug(f'Pre-warmed {len(tasks)} hosts')
+
+    async def _open_connection(self, session:aiohttp.ClientSession, origin:str):
+        '''a HEAD request leaves a keep-alive connection in the pool'''
+        async with session.head(origin, allow_redirects=False, headers={'User-Agent': config['user_agent']},
+                                timeout=aiohttp.ClientTimeout(total=float(config['connect_timeout']))):
+            pass
+
+    def _get_cached(self, key:tuple) -> Page:
+        try:
+            expires, page = self.cache[key]
+        except KeyError:
+            return None
+        if expires <= asyncio.get_running_loop().time():
+            del self.cache[key]
+            return None
+        self.stats['cached'] += 1
+        return page
+
+    def _settle(self, key:tuple, task:asyncio.Task):
+        '''cache the page once the download is done. Server errors are not cached, so that they can be retried'''
+        self.in_flight.pop(key, None)
+        ttl = float(config['fetch_cache_ttl'])
+        if task.cancelled() or task.exception() is not None or ttl <= 0 or task.result().status >= 500:
+            return
+        now = asyncio.get_running_loop().time()
+        if now >= self.next_sweep:
+            self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+            self.next_sweep = now + ttl
+        self.cache[key] = (now + ttl, task.result())
+
+    async def _download(self, url:str, cookies:dict=None, headers:dict=None, timeout:aiohttp.ClientTimeout=None, consume:Callable[[str, bool], Awaitable[bool]]=None) -> Page:
+        session = self._get_session()
+        timeout = timeout or session.timeout
+        if self._use_http2(url):
+            headers = {'Accept-Encoding': ACCEPT_ENCODING, **(headers or {})}
+            async with self.http2.get(url, cookies, headers, timeout) as resp:
+                return await self._read_body(url, resp.status_code, resp.headers, resp.charset_encoding or 'utf-8',
+                                             resp.aiter_raw(CHUNK_SIZE), consume)
+        async with session.get(url, cookies=cookies, headers=headers, timeout=timeout) as resp:
+            return await self._read_body(url, resp.status, resp.headers, get_encoding(resp), resp.content.iter_chunked(CHUNK_SIZE), consume)
+
+    def _use_http2(self, url:str) -> bool:
+        return self.http2.enabled() and self.http2.supports(url)
+
+    async def _read_body(self, url:str, status:int, headers:dict, encoding:str, chunks:AsyncIterator[bytes], consume:Callable[[str, bool], Awaitable[bool]]=None) -> Page:
+        if status == 304:
+            return Page(status, headers)
+        max_size = int(config['max_body_size'])
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        hash, text, size, complete = hashlib.blake2b(digest_size=16), [], 0, True
+        async for chunk in self._decompress(chunks, headers.get('Content-Encoding'), max_size):
+            if size + len(chunk) > max_size:
+                chunk, complete = chunk[:max_size-size], False
+                LOGGER.warning(f'Page exceeds {max_size} bytes, truncating: {url}')
+            size += len(chunk)
+            hash.update(chunk)
+            if consume is None:
+                text.append(decoder.decode(chunk))
+            elif await consume(decoder.decode(chunk), False):
+                LOGGER.debug(f'Stopped reading after {size} bytes: {url}')
+                return Page(status, headers, '', hash.digest(), False)
+            if not complete: break
+        if consume is None:
+            text.append(decoder.decode(b'', final=True))
+        else:
+            await consume(decoder.decode(b'', final=True), True)
+        return Page(status, headers, ''.join(text), hash.digest(), complete)
+
+    async def _decompress(self, chunks:AsyncIterator[bytes], encoding:str, max_size:int) -> AsyncIterator[bytes]:
+        '''yields the decompressed body as it arrives. Stops one byte past max_size,
+           so that a small compressed chunk can't expand beyond the limit'''
+        decompressor = get_decompressor(encoding)
+        remaining = max_size + 1
+        async for chunk in chunks:
+            self.stats['received_bytes'] += len(chunk)
+            try:
+                chunk = decompressor.decompress(chunk, remaining)
+            except Exception as e:
+                raise aiohttp.ClientPayloadError(f'Failed to decompress the page: {e}')
+            self.stats['body_bytes'] += len(chunk)
+            remaining -= len(chunk)
+            if chunk: yield chunk
+            if remaining <= 0: return
+        chunk = decompressor.flush()[:remaining]
+        self.stats['body_bytes'] += len(chunk)
+        if chunk: yield chunk
+
+
+def get_encoding(resp:aiohttp.ClientResponse) -> str:
+    '''charset of the response, known before the body is read'''
+    try:
+        return resp.get_encoding()
+    except RuntimeError:
+        return 'utf-8'
+
+
+fetcher = Fetcher()
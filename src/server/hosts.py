@@ -0,0 +1,150 @@
+import logging
+import random
+from time import monotonic
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from server.utils import singleton
+from server import config
+
+LOGGER = logging.getLogger('Hosts')
+
+
+def get_host(url:str) -> str:
+    return (urlsplit(url or '').hostname or '').lower()
+
+
+class TokenBucket:
+    '''Allows `burst` requests at once, refilled at `rate` requests per second'''
+
+    def __init__(self, rate:float, burst:float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def reserve(self) -> float:
+        '''takes a token and returns the number of seconds until it's actually available.
+           Tokens may be reserved in advance, so that waiting requests are spread evenly'''
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now-self.updated)*self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens/self.rate
+
+
+@singleton
+class HostLimiter:
+    '''Token bucket per target host, shared by all Monitors'''
+
+    def __init__(self):
+        self.buckets = dict()  # host: TokenBucket
+
+    def reserve(self, url:str) -> float:
+        '''returns the number of seconds to wait before requesting the url'''
+        host = get_host(url)
+        try:
+            bucket = self.buckets[host]
+        except KeyError:
+            bucket = self.buckets[host] = TokenBucket(float(config['host_rate']), float(config['host_burst']))
+        delay = bucket.reserve()
+        if delay: LOGGER.debug(f'Host {host} is busy, delaying request by {delay:.1f}s')
+        return delay
+
+
+class CircuitBreaker:
+    '''Stops requests to a failing host. Opens after `threshold` consecutive failures and backs off
+       exponentially with jitter. Once the backoff expires, a single probe request is let through
+       (half-open) - on success the breaker closes, otherwise it opens again with a longer backoff'''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold:int, backoff:float, max_backoff:float):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.failures = 0  # consecutive failures
+        self.trips = 0  # consecutive openings, determines the backoff
+        self.retry_at = datetime.min
+        self.probe = None  # key of the request let through in half-open state
+
+    def allow(self, key) -> float:
+        '''returns the number of seconds to wait before requesting the host'''
+        now = datetime.now()
+        if self.state == self.CLOSED or key == self.probe:
+            return 0
+        if now < self.retry_at:
+            return (self.retry_at - now).total_seconds()
+        # backoff expired or the probe was not reported in time - let one request through
+        self.state, self.probe = self.HALF_OPEN, key
+        self.retry_at = now + timedelta(seconds=self.backoff)
+        return 0
+
+    def record(self, success:bool) -> bool:
+        '''updates the breaker with the result of a request. Returns True if the state changed'''
+        prev = self.state
+        if self.state == self.OPEN:
+            pass  # results of requests sent before the breaker opened
+        elif success:
+            self.state, self.failures, self.trips, self.probe = self.CLOSED, 0, 0, None
+        else:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self._trip()
+        return self.state != prev
+
+    def _trip(self):
+        delay = min(self.backoff * 2**self.trips, self.max_backoff)
+        delay = delay/2 + random.uniform(0, delay/2)
+        self.state, self.probe = self.OPEN, None
+        self.trips += 1
+        self.retry_at = datetime.now() + timedelta(seconds=delay)
+
+    def describe(self) -> str:
+        if self.state == self.OPEN: return f"Backoff {self.retry_at.strftime('%H:%M:%S')}"
+        if self.state == self.HALF_OPEN: return 'Probing'
+        return ''
+
+
+@singleton
+class HostBreakers:
+    '''Circuit breaker per target host, shared by all Monitors'''
+
+    def __init__(self):
+        self.breakers = dict()  # host: CircuitBreaker
+        self.version = 0  # incremented on every state change
+
+    def _get(self, url:str) -> CircuitBreaker:
+        host = get_host(url)
+        try:
+            return self.breakers[host]
+        except KeyError:
+            self.breakers[host] = CircuitBreaker(int(config['breaker_threshold']), float(config['breaker_backoff']), float(config['breaker_max_backoff']))
+            return self.breakers[host]
+
+    def allow(self, url:str, key) -> float:
+        '''returns the number of seconds to wait before requesting the url'''
+        breaker = self._get(url)
+        state = breaker.state
+        delay = breaker.allow(key)
+        if breaker.state != state:
+            self.version += 1
+            LOGGER.info(f'Probing host {get_host(url)}')
+        return delay
+
+    def record(self, url:str, success:bool):
+        breaker = self._get(url)
+        if breaker.record(success):
+            self.version += 1
+            if breaker.state == breaker.OPEN:
+                LOGGER.warning(f'Host {get_host(url)} is failing, backing off until {breaker.retry_at:%H:%M:%S}')
+            else:
+                LOGGER.info(f'Host {get_host(url)} is back')
+
+    def describe(self, url:str) -> str:
+        '''human-readable state of the host for the dashboard'''
+        breaker = self.breakers.get(get_host(url))
+        return breaker.describe() if breaker else ''
+
+
+host_limiter = HostLimiter()
+host_breakers = HostBreakers()
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import aiohttp
+from http.cookiejar import CookieJar
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from server import config
+from common.utils import boolinize
+
+LOGGER = logging.getLogger('HTTP2')
+
+# HTTP/2 is optional and requires httpx[http2]
+try:
+    import httpx
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class DummyCookieJar(CookieJar):
+    '''Never stores cookies, like aiohttp.DummyCookieJar - cookies are sent per Query'''
+
+    def set_cookie(self, cookie): pass
+
+    def extract_cookies(self, response, request): pass
+
+
+class Http2Client:
+    '''HTTP/2 transport for the Fetcher. Concurrent requests to one origin are multiplexed
+       over a single connection. Support is discovered per origin on the first request -
+       origins that don't negotiate HTTP/2 are left to the HTTP/1.1 session'''
+
+    def __init__(self):
+        self.client:'httpx.AsyncClient' = None
+        self.protocols = dict()  # origin: negotiated http version
+        self.warned = False
+
+    def enabled(self) -> bool:
+        if not boolinize(config['http2']): return False
+        if not HTTP2 and not self.warned:
+            LOGGER.warning('http2 is enabled, but httpx[http2] is not installed. Using HTTP/1.1')
+            self.warned = True
+        return HTTP2
+
+    def supports(self, url:str) -> bool:
+        '''True unless the origin is known not to support HTTP/2'''
+        u = urlsplit(url)
+        return u.scheme == 'https' and self.protocols.get(f'{u.scheme}://{u.netloc}', 'HTTP/2') == 'HTTP/2'
+
+    def _get_client(self) -> 'httpx.AsyncClient':
+        if self.client is None:
+            limits = httpx.Limits(
+                max_connections=int(config['fetch_limit']),
+                keepalive_expiry=float(config['fetch_keepalive']),
+            )
+            self.client = httpx.AsyncClient(http2=True, limits=limits, follow_redirects=True, cookies=DummyCookieJar())
+            LOGGER.info('Created HTTP/2 client')
+        return self.client
+
+    @asynccontextmanager
+    async def get(self, url:str, cookies:dict, headers:dict, timeout:aiohttp.ClientTimeout):
+        '''yields the httpx response. Errors are raised as their aiohttp counterparts'''
+        headers = dict(headers or {})
+        if cookies: headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in cookies.items())
+        timeout = httpx.Timeout(None, connect=timeout.sock_connect, read=timeout.sock_read)
+        u = urlsplit(url)
+        origin = f'{u.scheme}://{u.netloc}'
+        try:
+            async with self._get_client().stream('GET', url, headers=headers, timeout=timeout) as resp:
+                if self.protocols.get(origin) != resp.http_version:
+                    self.protocols[origin] = resp.http_version
+                    LOGGER.info(f'{origin} negotiated {resp.http_version}' + ('' if resp.http_version == 'HTTP/2' else ', falling back to HTTP/1.1 session'))
+                yield resp
+        except httpx.TimeoutException as e:
+            raise asyncio.TimeoutError(str(e))
+        except httpx.TransportError as e:
+            raise aiohttp.ClientConnectionError(str(e))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            LOGGER.info('Closed HTTP/2 client')
+        self.client = None
+        self.protocols.clear()
@@ -3,9 +3,13 @@ from common import *
 from aiohttp import web
 from routes import routes
 import logging
-from users import UserManager
+from users import UserManager, auth_middleware
+from server.codec import compression_middleware
 from server import CWD
 from server.utils import config
+from server.fetch import fetcher
+from server.dumps import page_dumper
+from server.workers import worker_pool
 from common.utils import boolinize
 import ssl
 
@@ -25,10 +29,13 @@ async def shutdown_server(app):
         for uid, q_v in session_params['monitor'].queries.items():
             await q_v['query'].close_session()
         LOGGER.info(f"Session for user {username} closed successfuly")
+    await fetcher.close()
+    worker_pool.shutdown()
+    page_dumper.shutdown()
     LOGGER.info('Server shutdown')
             
 if __name__ == '__main__':
-    app = web.Application()
+    app = web.Application(middlewares=[compression_middleware, auth_middleware])
     app.add_routes(routes)
     app.on_shutdown.append(shutdown_server)
     ssl_context = get_ssl_context() if boolinize(config['secure']) else None
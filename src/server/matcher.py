@@ -0,0 +1,64 @@
+import re
+import logging
+
+LOGGER = logging.getLogger('Matcher')
+
+
+class Matcher:
+    '''Counts matches of every sequence and detects captcha keywords. Each sequence is counted
+       on its own, so that overlapping sequences don't take matches from each other.
+       Keywords only matter when no sequence matched, so they are looked for only then'''
+
+    def __init__(self, sequences:list[re.Pattern], keywords:set[str]):
+        self.sequences = sequences
+        self.keywords = keywords
+        self.kws = [kw for kw in keywords if kw]
+
+    def match(self, text:str) -> tuple[list[int], set[str]]:
+        '''returns number of matches per sequence and the set of captcha keywords found'''
+        counts = [len(r.findall(text)) for r in self.sequences]
+        return counts, set() if sum(counts) else self.find_keywords(text)
+
+    def find_keywords(self, text:str) -> set[str]:
+        '''for the few keywords of captcha_kw, substring search is faster than
+           a single pass of an alternation or an automaton'''
+        return {kw for kw in self.kws if kw in text}
+
+
+class StreamMatcher:
+    '''Feeds text to a Matcher in chunks. Matches ending within the last `overlap` characters
+       are deferred to the next chunk, so a match straddling a boundary is found as long as
+       it is not longer than `overlap`'''
+
+    def __init__(self, matcher:Matcher, min_matches:int, overlap:int):
+        self.matcher = matcher
+        self.min_matches = min_matches
+        self.overlap = overlap
+        self.counts = [0]*len(matcher.sequences)
+        self.matched_kws = set()
+        self.buffer = ''
+        self.patterns = dict(enumerate(matcher.sequences))
+        self.pos = dict.fromkeys(self.patterns, 0)  # where to resume searching for each pattern
+
+    def feed(self, text:str, final:bool=False) -> bool:
+        '''returns True once min_matches is reached, so the rest of the text can't change the result'''
+        self.buffer += text
+        limit = len(self.buffer) if final else len(self.buffer) - self.overlap
+        for key, pattern in self.patterns.items():
+            for m in pattern.finditer(self.buffer, self.pos[key]):
+                if m.end() > limit:
+                    self.pos[key] = m.start()
+                    break
+                self.counts[key] += 1
+                self.pos[key] = m.end() if m.end() > m.start() else m.end() + 1
+            else:
+                self.pos[key] = max(self.pos[key], limit)
+        if sum(self.counts):
+            self.matched_kws.clear()
+        else:
+            # the kept overlap is searched again, so keywords straddling chunks are found
+            self.matched_kws |= self.matcher.find_keywords(self.buffer)
+        keep = max(min(min(self.pos.values(), default=len(self.buffer)), len(self.buffer) - self.overlap), 0)
+        self.buffer = self.buffer[keep:]
+        self.pos = {k: v-keep for k, v in self.pos.items()}
+        return sum(self.counts) >= self.min_matches
@@ -1,14 +1,18 @@
-from collections import ChainMap
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from datetime import datetime, timedelta
-from time import monotonic
+from time import monotonic, time_ns
 import re
+import random
 from uuid import uuid4
 import logging
 from server.utils import get_randomization, safe_strptime, timer, config, warn_set
-from server.query import Query
+from server.query import Query, serialize, PARSERS
 from server.db_conn import db_connection
+from server.workers import worker_pool
+from server.scheduler import Scheduler
+from server.hosts import host_limiter, host_breakers
+from server.eta import Eta, compile_eta
 from common.utils import boolinize
 
 LOGGER = logging.getLogger('Monitor')
@@ -23,6 +27,23 @@ class Monitor:
         self.DEFAULT_DATE = datetime(1970,1,1)
         self.MIN_INTERVAL = int(config['min_query_interval'])
         self.queries_run_counter = 0
+        self.schedule = Scheduler()
+        self.randomization = dict()  # uid: randomization drawn for the pending run
+        self.adaptive = dict()  # uid: learned interval of adaptive queries
+        self.backoff = dict()  # uid: (consecutive failures, time of the next attempt) of failing queries
+        self.last_ran = set()  # uids marked as new, but not yet reported
+        self.host_slots = set()  # uids delayed by the host limiter, that already hold a token
+        self.running = set()  # uids whose request was sent, but not finished yet
+        self.snapshot = dict()  # serialized results of the latest scan
+        self.dirty = set()  # uids modified since the snapshot was taken
+        self.versions = dict()  # uid: incremented whenever the query changes
+        self.fragments = dict()  # uid: (version, host status, serialized query)
+        self.revision = time_ns() // 10**6  # of the snapshot. Starts from the clock, so that cursors from before a restart are not reused
+        self.horizon = self.revision  # deltas since older revisions are not known
+        self.changelog = dict()  # uid: revision of the last change, ordered by revision
+        self.removed = dict()  # uid: revision of the removal, ordered by revision
+        self.updated = asyncio.Event()  # set and replaced on every new revision
+        self.hosts_version = host_breakers.version  # state of the hosts in the snapshot
         self._create_eta_dict()
         self.warnings = warn_set()
         
@@ -52,8 +73,11 @@ class Monitor:
         d, is_valid = await self._validate_query(d)
         if not is_valid: return False, self._res_msg('Query validation failed', 'with errors: ')
         cookies, d['cookies_filename'] = await self.db_conn.setdefault_cookie_file(username=self.username, filename=d['cookies_filename'])
-        d['query'] = Query(url=d['url'], sequence=d['sequence'], cookies=cookies, min_matches=d['min_matches'], mode=d['mode'])
+        d['query'] = Query(url=d['url'], sequence=d['sequence'], cookies=cookies, min_matches=d['min_matches'], mode=d['mode'], parser=d['parser'],
+                           connect_timeout=d['connect_timeout'], read_timeout=d['read_timeout'])
         self.queries[d['uid']] = d
+        self._reschedule(d)
+        self._touch(d['uid'])
         LOGGER.debug(f'[{self.username}] added Query: {self.queries[d["uid"]]}')
         return True, self._res_msg('Query added successfully')
 
@@ -89,6 +113,8 @@ class Monitor:
         # Parse ETA
         vd['eta'] = await self._parse_eta(d.get('eta'))
         vd['cooldown'] = await self._parse_cooldown(d.get('cooldown', '0'), vd['interval'])
+        vd['adaptive'] = await self._valpar(d, 'adaptive', exp_inst=boolinize, d_val=False)
+        vd['max_interval'] = await self._parse_max_interval(d.get('max_interval'), vd['interval'])
 
         vd['target_url'] = d.get('target_url')
         
@@ -105,6 +131,9 @@ class Monitor:
         vd['last_match_datetime'] = await self._valpar(d, 'last_match_datetime',   exp_inst=safe_strptime,     d_val=self.DEFAULT_DATE                   )
         vd['is_new'] =              await self._valpar(d, 'is_new',                exp_inst=boolinize,         d_val=False                               )
         vd['status'] =              await self._valpar(d, 'status',                exp_inst=int,               d_val=-1                                  )
+        vd['parser'] =              await self._valpar(d, 'parser',                exp_inst=str,               d_val=config['default_parser'], v_func=self._validate_parser)
+        vd['connect_timeout'] =     await self._valpar(d, 'connect_timeout',       exp_inst=float,             d_val=None, v_func=self._validate_timeout )
+        vd['read_timeout'] =        await self._valpar(d, 'read_timeout',          exp_inst=float,             d_val=None, v_func=self._validate_timeout )
         vd['cookies_filename'] =    await self._valpar(d, 'cookies_filename',      exp_inst=str,               d_val=None,                                
                                                                                   d_func=self.db_conn.create_cookies_filename,                          
                                                                                   filename=vd['alias'], username=self.username                           )
@@ -132,6 +161,14 @@ class Monitor:
             self.warnings.add(f'interval too low (min:{self.MIN_INTERVAL})')
         return res
 
+    async def _parse_max_interval(self, m:str, i:int) -> int:
+        '''upper bound of the adaptive interval. Defaults to adaptive_max_factor times the interval'''
+        try:
+            m = await self._parse_time(str(m))
+        except (TypeError, ValueError):
+            m = 0
+        return max(m, i) if m else i*int(config['adaptive_max_factor'])
+
     async def _parse_cooldown(self, c:str, i:int):
         c = await self._parse_time(str(c))
         return max(c, i)
@@ -152,12 +189,25 @@ class Monitor:
     async def _validate_min_matches(self, min_matches:str):
         return max(int(min_matches), 1)
 
-    async def _parse_eta(self, eta) -> dict:
-        '''create eta dict from string'''
+    async def _validate_timeout(self, timeout:str) -> float:
+        '''seconds, or None to use the server default'''
+        timeout = float(timeout)
+        if timeout <= 0: raise ValueError
+        return timeout
+
+    async def _validate_parser(self, parser:str) -> str:
+        parser = parser.strip().lower() if isinstance(parser, str) else parser
+        if parser not in PARSERS:
+            if parser: self.warnings.add(f"unsupported parser: {parser} (available: {', '.join(sorted(PARSERS))})")
+            raise ValueError
+        return parser
+
+    async def _parse_eta(self, eta) -> Eta:
+        '''create compiled eta from string'''
         w = list()
         eta = eta.get('raw', '') if isinstance(eta, dict) else eta
         d = {'dow':[], 'dt':[], 'dow_span':[], 'dt_span':[], 'time_span':[], 'raw': eta or ''}
-        if not eta or not isinstance(eta, str): return d
+        if not eta or not isinstance(eta, str): return Eta(d)
         for p in eta.lower().split(','):
             for k, v in self.eta_re.items():
                 if v[0].search(p):
@@ -172,7 +222,7 @@ class Monitor:
                 w.append(p)
         w = f"invalid ETA rules: {', '.join(w)}" if w else ''
         self.warnings.add(w)
-        return d
+        return Eta(d)
 
     async def edit_query(self, d:dict) -> bool:
         '''update existing query with new parameters (with validation)'''
@@ -191,7 +241,15 @@ class Monitor:
                                                 sequence=self.queries[uid]['sequence'], 
                                                 cookies=cookies, 
                                                 min_matches=self.queries[uid]['min_matches'], 
-                                                mode=self.queries[uid]['mode'])
+                                                mode=self.queries[uid]['mode'],
+                                                parser=self.queries[uid]['parser'],
+                                                connect_timeout=self.queries[uid]['connect_timeout'],
+                                                read_timeout=self.queries[uid]['read_timeout'])
+            self.randomization.pop(uid, None)
+            self.adaptive.pop(uid, None)
+            self.backoff.pop(uid, None)
+            self._reschedule(self.queries[uid])
+            self._touch(uid)
             res, msg = True, self._res_msg('Query edited successfully')
         except Exception as e:
             LOGGER.error(traceback.format_exc())
@@ -202,48 +260,239 @@ class Monitor:
         d, s = await self._validate_query(d)
         if not s: return False, self._res_msg('Query restore failed', ' with errors: ')
         cookies, d['cookies_filename'] = await self.db_conn.setdefault_cookie_file(username=self.username, filename=d['cookies_filename'])
-        d['query'] = Query(url=d['url'], sequence=d['sequence'], cookies=cookies, min_matches=d['min_matches'], mode=d['mode'])
+        d['query'] = Query(url=d['url'], sequence=d['sequence'], cookies=cookies, min_matches=d['min_matches'], mode=d['mode'], parser=d['parser'],
+                           connect_timeout=d['connect_timeout'], read_timeout=d['read_timeout'])
         self.queries[d['uid']] = d
+        self._reschedule(d)
+        self._touch(d['uid'])
         return True, self._res_msg(f'Query restored: {d["alias"]}')
 
     async def scan(self) -> tuple[dict, str]:
-        '''Uses ThreadPoolExecutor to perform a run of scheduled queries and return results'''
+        '''Runs due queries concurrently on the event loop and returns results'''
         start_all = monotonic()
         self.queries_run_counter = 0
-        with ThreadPoolExecutor() as executor:
-            _res = executor.map(self._scan_one, self.queries.values())
-        self.queries = dict(ChainMap(*reversed(list(_res))))  # merge list of dicts into a single dict, retaining order
+        due = [self.queries[uid] for uid in self.schedule.pop_due(datetime.now()) if uid in self.queries]
+        tasks = {asyncio.ensure_future(self._scan_one(q)):q for q in due}
+        done, pending = await asyncio.wait(tasks, timeout=float(config['scan_deadline'])) if tasks else (set(), set())
+        for t in pending: t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        _res = [t.result() for t in done if not t.cancelled()] + [self._timed_out(tasks[t]) for t in pending]
+        self.running.clear()
+        self.last_ran.update(uid for r in _res for uid, q in r.items() if q['is_new'])
+        self._update_snapshot()
         if self.queries_run_counter>1: 
             LOGGER.info(f"[{self.username}] scanned {self.queries_run_counter} queries in {(monotonic()-start_all)*1000:.0f}ms")
         return self.queries, self._res_msg('Scanned Queries')
 
-    def _scan_one(self, q) -> dict:
+    async def get_snapshot(self, since:int=None) -> tuple[dict, str]:
+        '''returns serialized results of the latest scan. New matches are reported only once.
+           Given the client's revision, only the changes since then are returned'''
+        if since is not None:
+            res = self._get_delta(since)
+        else:
+            res = dict(self.snapshot) if self.last_ran else self.snapshot
+        if self.last_ran:
+            for uid in self.last_ran:
+                if uid in self.queries:
+                    self.queries[uid]['is_new'] = False
+                    self._touch(uid)
+            self.last_ran.clear()
+            self._update_snapshot()
+        return res, self._res_msg('Returned latest scan results')
+
+    async def get_revision(self) -> tuple[int, str]:
+        '''returns the revision of the snapshot, including changes of the hosts' state
+           made since the latest scan, e.g. by scans of other users'''
+        self._update_snapshot()
+        return self.revision, self._res_msg('Returned the dashboard revision')
+
+    async def wait_for_update(self, since:int, timeout:float=None) -> tuple[bool, str]:
+        '''waits until the snapshot is newer than the revision. Returns False on timeout'''
+        if since == self.revision:
+            try:
+                await asyncio.wait_for(self.updated.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False, self._res_msg('No changes')
+        return True, self._res_msg('Dashboard updated')
+
+    async def get_all_queries(self) -> tuple[dict, str]:
+        '''returns serialized current state of all queries'''
+        return {k:self._serialize(k) for k in self.queries}, self._res_msg('Returned all queries')
+
+    def _get_delta(self, since:int) -> dict:
+        '''queries changed and removed since the revision. Unknown revisions get the full snapshot'''
+        if not self.horizon <= since <= self.revision:
+            return dict(revision=self.revision, full=True, queries=dict(self.snapshot), removed=list())
+        queries, removed = dict(), list()
+        for uid in reversed(self.changelog):
+            if self.changelog[uid] <= since: break
+            queries[uid] = self.snapshot[uid]
+        for uid in reversed(self.removed):
+            if self.removed[uid] <= since: break
+            removed.append(uid)
+        return dict(revision=self.revision, full=False, queries=queries, removed=removed)
+
+    def _update_snapshot(self):
+        '''applies the queries modified since the last update to the snapshot under a new revision'''
+        if self.hosts_version != host_breakers.version:
+            self.hosts_version = host_breakers.version
+            self.dirty.update(self.queries)  # only the ones with a new host status are logged
+        if not self.dirty: return
+        revision, changed = self.revision + 1, False
+        for uid in self.dirty:
+            if uid in self.queries:
+                fragment = self._serialize(uid)
+                if self.snapshot.get(uid) is fragment: continue
+                self.snapshot[uid] = fragment
+                self.changelog.pop(uid, None)
+                self.changelog[uid] = revision
+                self.removed.pop(uid, None)
+                changed = True
+            elif self.snapshot.pop(uid, None) is not None:
+                self.changelog.pop(uid, None)
+                self.removed[uid] = revision
+                changed = True
+        self.dirty.clear()
+        if not changed: return  # e.g. state of a host not used by this user
+        while len(self.removed) > int(config['dashboard_tombstones']):
+            self.horizon = self.removed.pop(next(iter(self.removed)))
+        self.revision = revision
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def _touch(self, uid:str):
+        '''marks the query as changed, so that it's serialized again'''
+        self.versions[uid] = self.versions.get(uid, 0) + 1
+        self.dirty.add(uid)
+
+    def _serialize(self, uid:str) -> dict:
+        '''returns the serialized query, cached until the query or the state of its host changes'''
+        key = (self.versions.get(uid, 0), host_breakers.describe(self.queries[uid]['url']))
+        try:
+            version, host_status, res = self.fragments[uid]
+            if (version, host_status) == key: return res
+        except KeyError:
+            pass
+        res = serialize(self.queries[uid])
+        self.fragments[uid] = (*key, res)
+        return res
+
+    async def _scan_one(self, q) -> dict:
         '''Runs a request for 1 query if conditions are met. Returns dict[uid:query_params]'''
-        if self._should_run(q):
-            start = monotonic()
-            prev_found = q['found']
-            q['found'], q['status'] = q['query'].run()
+        delay = self._reserve_host(q) if self._should_run(q) else None
+        if delay == 0:
+            async with worker_pool.quota(self.username):
+                start = monotonic()
+                prev_found = q['found']
+                self.running.add(q['uid'])
+                q['found'], q['status'] = await q['query'].run()
+                self.running.discard(q['uid'])
             q['last_match_datetime'] = self._get_last_match_datetime(prev_found, q['found'], q['last_match_datetime'], q['is_recurring'])
             q['last_run'] = datetime.now()
+            host_breakers.record(q['url'], q['status'] == 0)
+            if q['status'] in {2, 3}:
+                self._back_off(q)
+            else:
+                self.backoff.pop(q['uid'], None)
             if q['status'] in {0, 1}:
                 q['cycles']+=1
             q['is_new'] = True
+            self._touch(q['uid'])
             self.queries_run_counter+=1
+            self.randomization.pop(q['uid'], None)
+            if q['adaptive']: self._adapt_interval(q)
             LOGGER.info(f"[{self.username}] ran query: {q['alias']} in {1000*(monotonic()-start):.0f}ms Found: {q['found']}, Status: {q['status']}")
         else: 
-            q['is_new'] = False
+            q['is_new'] = q['uid'] in self.last_ran  # keep until reported
+        if delay:
+            self.schedule.push(q['uid'], datetime.now() + timedelta(seconds=delay))
+        else:
+            self._reschedule(q)
+        return {q['uid']:q}
+
+    def _timed_out(self, q:dict) -> dict:
+        '''marks a query that missed the scan deadline, so that it's re-run on the next scan.
+           Queries still waiting for the user's quota never sent a request and are only rescheduled'''
+        if q['uid'] not in self.running:
+            q['is_new'] = q['uid'] in self.last_ran
+            self.host_slots.add(q['uid'])  # the host token was taken, but not used
+            self._reschedule(q)
+            LOGGER.info(f"[{self.username}] query {q['alias']} was still queued at the scan deadline")
+            return {q['uid']:q}
+        q['status'] = 3
+        q['last_run'] = datetime.now()
+        q['is_new'] = True
+        self._touch(q['uid'])
+        host_breakers.record(q['url'], False)
+        self._back_off(q)
+        self._reschedule(q)
+        LOGGER.warning(f"[{self.username}] query {q['alias']} missed the scan deadline")
         return {q['uid']:q}
 
+    def _reserve_host(self, q:dict) -> float:
+        '''returns seconds to wait for the target host. The query keeps its slot until it runs'''
+        delay = host_breakers.allow(q['url'], (self.username, q['uid']))
+        if delay:
+            return delay
+        if q['uid'] in self.host_slots:
+            self.host_slots.discard(q['uid'])
+            return 0
+        delay = host_limiter.reserve(q['url'])
+        if delay: self.host_slots.add(q['uid'])
+        return delay
+
     def _should_run(self, q:dict):
-        if q['status'] in {-1, 2} and q['cycles_limit']>=0:
-            res = True
-        else:
-            eta_c = self._eta_condition(q['eta'])
-            res = eta_c and (not q['found'] or q['is_recurring']) and \
-                (q['cycles'] < q['cycles_limit'] if q['cycles_limit'] != 0 else True) and \
-                q['last_run'] + timedelta(minutes=q['cooldown'] if q['found'] \
-                else (q['interval']+get_randomization(q['interval'], q['randomize']))) <= datetime.now() 
-        return res
+        due = self._next_run(q)
+        return due is not None and due <= datetime.now()
+
+    def _next_run(self, q:dict) -> datetime:
+        '''returns the time at which the query becomes due or None if it should not run anymore'''
+        if q['cycles_limit'] < 0:
+            return None
+        if q['status'] in {2, 3} and q.get('uid') in self.backoff:
+            return self.backoff[q['uid']][1]
+        if q['status'] in {-1, 2, 3}:
+            return self.DEFAULT_DATE
+        if (q['found'] and not q['is_recurring']) or (q['cycles_limit'] != 0 and q['cycles'] >= q['cycles_limit']):
+            return None
+        due = q['last_run'] + timedelta(minutes=q['cooldown'] if q['found'] else (self._get_interval(q)+self._get_randomization(q)))
+        n = max(due, datetime.now())
+        window = compile_eta(q['eta']).next_window(n)
+        return due if window == n else window
+
+    def _back_off(self, q:dict):
+        '''delays the next attempt of a failed query exponentially with jitter, up to its interval.
+           The host's breaker alone does not stop a single failing url on a healthy host'''
+        failures = self.backoff.get(q['uid'], (0, None))[0] + 1
+        delay = min(float(config['breaker_backoff']) * 2**(failures-1), float(config['breaker_max_backoff']), self._get_interval(q)*60)
+        delay = delay/2 + random.uniform(0, delay/2)
+        self.backoff[q['uid']] = (failures, datetime.now() + timedelta(seconds=delay))
+
+    def _get_interval(self, q:dict) -> float:
+        '''interval learned for adaptive queries, the base interval otherwise'''
+        if q.get('adaptive'):
+            return self.adaptive.get(q['uid'], q['interval'])
+        return q['interval']
+
+    def _adapt_interval(self, q:dict):
+        '''halves the interval when the page changed and stretches it while it doesn't,
+           so that the polling rate follows the change rate within interval and max_interval'''
+        changed = q['query'].changed
+        if changed is None: return  # failed or first run
+        interval = self._get_interval(q) * (0.5 if changed else float(config['adaptive_growth']))
+        self.adaptive[q['uid']] = min(max(interval, q['interval']), q['max_interval'])
+        LOGGER.debug(f"[{self.username}] adaptive interval of {q['alias']}: {self.adaptive[q['uid']]:.1f}m")
+
+    def _get_randomization(self, q:dict) -> float:
+        '''randomization is drawn once per run, so that re-checking the query does not re-roll it'''
+        if q.get('uid') is None:
+            return get_randomization(q['interval'], q['randomize'])
+        if q['uid'] not in self.randomization:
+            self.randomization[q['uid']] = get_randomization(self._get_interval(q), q['randomize'])
+        return self.randomization[q['uid']]
+
+    def _reschedule(self, q:dict):
+        self.schedule.push(q['uid'], self._next_run(q))
 
     def _get_last_match_datetime(self, prev_found, found, last_match_datetime, recurring):
             if found or (recurring and not prev_found):
@@ -252,37 +501,8 @@ class Monitor:
                 return last_match_datetime
 
     def _eta_condition(self, eta:dict, n:datetime=None) -> bool:
-        dow, time_span, dt, dt_span, dow_span = [True]*5
-        n = n or datetime.now()
-
-        for d in eta['dow']:
-            dow = n.weekday() == d
-            if dow: break
-        if not dow: return False
-
-        for d in eta['time_span']:
-            time_span = d[0] <= (n.hour, n.minute) <= d[1]
-            if time_span: break
-        if not time_span: return False
-
-        for d in eta['dt_span']:
-            dt_span = d[0] <= n <= d[1]+timedelta(days=1)
-            if dt_span: break
-        if not dt_span: return False
-
-        for d in eta['dow_span']:
-            dow_span = d[0] <= n.weekday() <= d[1]
-            if dow_span: break
-        if not dow_span: return False
-
-        for d in eta['dt']:
-            dt = d == (n.day, n.month, n.year)
-            if dt: break
-        if not dt: return False
-            
-        return True
-            
-        
+        return compile_eta(eta).is_open(n or datetime.now())
+
     async def clean_queries(self):
         new_queries = dict()
         removed_queries = set()
@@ -291,6 +511,10 @@ class Monitor:
                 new_queries[k] = v
             else:
                 await self.close_session(k)
+                self.schedule.remove(k)
+                self.versions.pop(k, None)
+                self.fragments.pop(k, None)
+                self.dirty.add(k)
                 removed_queries.add(v['alias'])
         self.queries = new_queries
         msg = f"[{self.username}] removed queries: {', '.join(removed_queries)}"
@@ -300,7 +524,17 @@ class Monitor:
     async def delete_query(self, uid) -> tuple[bool, str]:
         try:
             alias = self.queries[uid]['alias']
+            await self.close_session(uid)
+            self.schedule.remove(uid)
+            self.randomization.pop(uid, None)
+            self.adaptive.pop(uid, None)
+            self.backoff.pop(uid, None)
             del self.queries[uid]
+            self.last_ran.discard(uid)
+            self.host_slots.discard(uid)
+            self.versions.pop(uid, None)
+            self.fragments.pop(uid, None)
+            self.dirty.add(uid)
             LOGGER.info(f"[{self.username}] deleted query '{alias}'")
             return True, f"Query {alias} was removed"
         except KeyError:
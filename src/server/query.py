@@ -1,69 +1,199 @@
 from bs4 import BeautifulSoup
-from copy import deepcopy
 import logging
 from server.utils import safe_date_fmt
-from server import config, CWD
+from server import config
+from server.fetch import fetcher, Page
+from server.workers import worker_pool
+from server.matcher import Matcher, StreamMatcher
+from server.hosts import host_breakers
+from server.dumps import page_dumper
+from server.retries import retry_budget
 from common.utils import boolinize
-import requests
+import aiohttp
+import asyncio
+import random
 import re
-import os
+from typing import Callable
 
 LOGGER = logging.getLogger('Query')
-PAGEDUMP = os.path.realpath(f'{CWD}/../../page_dump')
 
 captcha_kw = set(config['captcha_kw'].lower().split(';'))
 
+# 'raw' matches on the decoded body, others are BeautifulSoup backends
+try:
+    import lxml
+    PARSERS = {'raw', 'html.parser', 'lxml'}
+except ImportError:
+    PARSERS = {'raw', 'html.parser'}
+
 class Query:
     '''Represents a single search'''
 
-    def __init__(self, url:str, sequence:str, cookies:dict=dict(), min_matches:int=1, mode:str='exists'):
+    def __init__(self, url:str, sequence:str, cookies:dict=dict(), min_matches:int=1, mode:str='exists', parser:str='html.parser',
+                 connect_timeout:float=None, read_timeout:float=None):
         self.url = url
         self.min_matches = min_matches
         self.re_compilers:list = [re.compile(s.lower()) for s in sequence.split('\&')]
+        self.matcher = Matcher(self.re_compilers, captcha_kw)
+        self.counts = [0]*len(self.re_compilers)  # matches per sequence on the last parsed page
         self.cookies = cookies
         self.headers = {'User-Agent': config['user_agent']}
         self.mode = mode.lower() == 'exists'
-        self.allowed_chars = 'qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM_1234567890'
+        self.parser = parser if parser in PARSERS else 'html.parser'
+        if self.parser != parser: LOGGER.warning(f"Parser '{parser}' is not available, using {self.parser}")
         self.do_dump_page_content = boolinize(config['dump_page_content'])
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout or float(config['connect_timeout']), 
+                                             sock_read=read_timeout or float(config['read_timeout']))
+        self.validators = dict()  # conditional request headers for the last parsed page
+        self.last_res = (0, 0)  # number of matches and status code of the last parsed page
+        self.digest = None  # fingerprint of the last parsed page
+        self.stats = dict(runs=0, parsed=0, not_modified=0, unchanged=0, streamed=0, early_exit=0, retries=0)
+        self.retries = 0  # retries during the last run
+        self.changed = None  # whether the content changed on the last run, None if unknown
+        self.task:asyncio.Task = None  # task awaiting the run in progress
 
     def __repr__(self):
         return f"Query(url={self.url}, re_compilers={self.re_compilers})"
 
     async def close_session(self):
-        # Kept in case an aiohttp.ClientSession is needed
-        #self.session.close()
-        pass
+        '''Cancel the run in progress, when the query is edited, removed or the server shuts down.
+           Downloads are shielded, so one shared with other Queries keeps going'''
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
 
-    def run(self) -> tuple[bool, int]:
-        status_code = 0
+    async def run(self) -> tuple[bool, int]:
+        self.retries, self.changed = 0, None
+        self.task = asyncio.current_task()
         try:
-            #TODO add headers if turns out to be needed
-            html = requests.get(self.url, cookies=self.cookies).text 
-            parsed_html = str(BeautifulSoup(html, 'html.parser')).lower()
-            res = sum(len(r.findall(parsed_html)) for r in self.re_compilers)
-            if res == 0:
-                matched_kws = {kw for kw in captcha_kw if kw in parsed_html}
-                if matched_kws: 
-                    LOGGER.warning(f'Page Access Denied: {matched_kws}')
-                    status_code = 1
-            if self.do_dump_page_content: self.dump_page_content(parsed_html)
-        except requests.exceptions.ConnectionError:
+            if self.parser == 'raw':
+                return await self._run_streamed()
+            page = await self._fetch()
+            self.stats['runs'] += 1
+            if page.status == 304:
+                res, status_code = self.last_res
+                self.stats['not_modified'] += 1
+                self.changed = False
+                LOGGER.debug(f'Page not modified: {self.url}')
+            elif page.digest and page.digest == self.digest:
+                self.validators = self._get_validators(page.headers)
+                res, status_code = self.last_res
+                self.stats['unchanged'] += 1
+                self.changed = False
+                LOGGER.debug(f'Page content unchanged: {self.url}')
+            else:
+                self.validators = self._get_validators(page.headers)
+                # Parsing is CPU-bound, keep it off the event loop
+                res, status_code = await worker_pool.submit(self._match, page)
+                if self.digest: self.changed = True
+                self.last_res, self.digest = (res, status_code), page.digest
+                self.stats['parsed'] += 1
+        except asyncio.TimeoutError:
+            LOGGER.warning(f'Timed out during query: {self.url}')
+            status_code = 3
+            res = 0
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError):
             LOGGER.warning(f'Connection Lost during query: {self.url}')
             status_code = 2
             res = 0
+        finally:
+            self.task = None
         return (res >= self.min_matches) == self.mode, status_code
 
+    async def _run_streamed(self) -> tuple[bool, int]:
+        '''match the body while it's being read and stop once the result is decided'''
+        self._refresh_matcher()
+        stream, content = None, None
+        def reset():
+            nonlocal stream, content
+            stream, content = StreamMatcher(self.matcher, self.min_matches, int(config['stream_overlap'])), list()
+        async def consume(text:str, final:bool) -> bool:
+            text = text.lower()
+            if self.do_dump_page_content: content.append(text)
+            return await worker_pool.submit(stream.feed, text, final)
+        reset()
+        page = await self._fetch(consume, reset)
+        self.stats['runs'] += 1
+        if page.status == 304:
+            res, status_code = self.last_res
+            self.stats['not_modified'] += 1
+            self.changed = False
+            LOGGER.debug(f'Page not modified: {self.url}')
+        else:
+            self.validators = self._get_validators(page.headers)
+            self.counts = stream.counts
+            res, status_code = self._evaluate(stream.matched_kws)
+            if self.do_dump_page_content: self.dump_page_content(''.join(content))
+            if self.digest and page.complete: self.changed = page.digest != self.digest
+            self.last_res, self.digest = (res, status_code), page.digest
+            self.stats['streamed'] += 1
+            if not page.complete and res >= self.min_matches: self.stats['early_exit'] += 1
+        return (res >= self.min_matches) == self.mode, status_code
+
+    async def _fetch(self, consume:Callable=None, reset:Callable=None) -> Page:
+        '''fetch the page, retrying connection resets and server errors.
+           If the retries are exhausted, the last response or error is returned as is'''
+        while True:
+            try:
+                page = await fetcher.get(self.url, cookies=self.cookies, headers={**self.headers, **self.validators}, 
+                                         timeout=self.timeout, consume=consume)
+                if page.status < 500 or not self._may_retry(f'HTTP {page.status}'):
+                    return page
+            except asyncio.TimeoutError:
+                raise  # already waited long enough, left for the scan deadline
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                if not self._may_retry(e.__class__.__name__): raise
+            await asyncio.sleep(random.uniform(0, float(config['retry_backoff']) * 2**(self.retries-1)))
+            if reset: reset()
+
+    def _may_retry(self, reason:str) -> bool:
+        if self.retries >= int(config['retry_attempts']):
+            return False
+        if not retry_budget.take():
+            LOGGER.warning(f'Retry budget exhausted, not retrying: {self.url}')
+            return False
+        self.retries += 1
+        self.stats['retries'] += 1
+        LOGGER.info(f'Retrying ({self.retries}) after {reason}: {self.url}')
+        return True
+
+    def _get_validators(self, headers:dict) -> dict:
+        '''create conditional request headers from response headers'''
+        validators = dict()
+        if headers.get('ETag'): validators['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified'): validators['If-Modified-Since'] = headers['Last-Modified']
+        return validators
+
+    def _match(self, page:Page) -> tuple[int, int]:
+        '''returns number of matches and the status code'''
+        parsed_html = page.parsed.get(self.parser)
+        if parsed_html is None:
+            parsed_html = page.parsed[self.parser] = str(BeautifulSoup(page.text, self.parser)).lower()
+        self._refresh_matcher()
+        self.counts, matched_kws = self.matcher.match(parsed_html)
+        if self.do_dump_page_content: self.dump_page_content(parsed_html)
+        return self._evaluate(matched_kws)
+
+    def _refresh_matcher(self):
+        if self.matcher.keywords is not captcha_kw:
+            self.matcher = Matcher(self.re_compilers, captcha_kw)  # captcha_kw was reloaded
+
+    def _evaluate(self, matched_kws:set) -> tuple[int, int]:
+        '''returns number of matches and the status code'''
+        status_code = 0
+        res = sum(self.counts)
+        if res == 0:
+            if matched_kws: 
+                LOGGER.warning(f'Page Access Denied: {matched_kws}')
+                status_code = 1
+        return res, status_code
+
     def dump_page_content(self, parsed_html:str):
-        filename = '_'.join(re.split(rf'[^{self.allowed_chars}]+', self.url))
-        with open(f'{PAGEDUMP}/{filename}.txt', 'w') as f:
-            f.write(parsed_html)
-        LOGGER.debug(f"Dumped content of a page {self.url}")
-            
+        page_dumper.submit(self.url, parsed_html)
 
 
 def serialize(d:dict) -> dict:
     '''Prepare Query object to be sent as a web response'''
-    d = deepcopy(d)
+    d = {k:v for k, v in d.items() if k != 'query'}
     template = dict(
         eta = lambda x: x.get('raw', ''),
         last_run = lambda x: safe_date_fmt(x),
@@ -74,8 +204,7 @@ def serialize(d:dict) -> dict:
             d[k] = v(d[k])
         except AttributeError as e:
             pass
-    try: del d['query']
-    except KeyError: pass
     d['target_url'] = d['target_url'] or d['url']
+    d['host_status'] = host_breakers.describe(d['url'])
     return d
    
@@ -0,0 +1,25 @@
+import logging
+from server.utils import singleton
+from server import config
+
+LOGGER = logging.getLogger('Retries')
+
+
+@singleton
+class RetryBudget:
+    '''Limits the number of retries of all Queries per scan, so that retries
+       don't multiply the load during a wide outage. Reset on every scan'''
+
+    def __init__(self):
+        self.left = int(config['retry_budget'])
+
+    def reset(self):
+        self.left = int(config['retry_budget'])
+
+    def take(self) -> bool:
+        if self.left <= 0: return False
+        self.left -= 1
+        return True
+
+
+retry_budget = RetryBudget()
@@ -1,10 +1,16 @@
 from aiohttp import web
+import asyncio
 import logging
+import zlib
 from query import serialize
-from users import user_manager, require_login
+from users import user_manager
+from server import config
+from server.codec import loads, dumps, json_response, etag_matches
 
 routes = [
     web.post('/get_dashboard', lambda req: get_dashboard(req)),
+    web.post('/get_dashboard_delta', lambda req: get_dashboard_delta(req)),
+    web.get('/subscribe', lambda req: subscribe(req)),
     web.post('/auth', lambda req: login_user(req)),
     web.post('/add_query', lambda req: add_query_to_dashboard(req)),
     web.post('/save', lambda req: save_queries(req)),
@@ -14,6 +20,7 @@ routes = [
     web.post('/edit_query', lambda req: edit_query(req)),
     web.post('/refresh_data', lambda req: refresh_data(req)),
     web.post('/get_all_queries', lambda req: get_all_queries(req)),
+    web.post('/get_stats', lambda req: get_stats(req)),
     web.post('/get_sound', lambda req: get_sound_file(req)),
     web.post('/get_settings', lambda req: get_settings(req)),
     web.post('/edit_settings', lambda req: edit_settings(req)),
@@ -23,23 +30,83 @@ routes = [
 
 LOGGER = logging.getLogger('Routes')
 
-@require_login
+async def dashboard_etag(request:web.Request) -> str:
+    '''strong ETag of the user's dashboard revision'''
+    revision = await user_manager.get_dashboard_revision(request['username'])
+    return f'"{revision:x}-{zlib.crc32(request["username"].encode()):08x}"'
+
+
+def not_modified(request:web.Request, etag:str) -> web.Response:
+    '''304 is defined for GET and HEAD only. The dashboard is polled with POST, as the body
+       carries the credentials, so a matching If-None-Match fails the precondition with 412'''
+    return web.Response(status=304 if request.method in {'GET', 'HEAD'} else 412, headers={'ETag': etag})
+
+
 async def get_dashboard(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.sessions[data['username']]['monitor'].scan()
-    res = {k:serialize(v) for k, v in res.items()}
-    return web.json_response(res)
+    etag = await dashboard_etag(request)
+    if etag_matches(request, etag):
+        return not_modified(request, etag)
+    res, msg = await user_manager.get_dashboard(request['username'])
+    return json_response(res, headers={'ETag': etag})
+
+
+async def get_dashboard_delta(request:web.Request):
+    '''returns queries changed since the client's revision'''
+    data = request['data']
+    try:
+        since = int(data.get('revision') or 0)
+    except (TypeError, ValueError):
+        since = 0
+    etag = await dashboard_etag(request)
+    if etag_matches(request, etag):
+        return not_modified(request, etag)
+    res, msg = await user_manager.get_dashboard(request['username'], since)
+    return json_response(res, headers={'ETag': etag})
+
+
+async def subscribe(request:web.Request):
+    '''WebSocket pushing dashboard deltas as soon as queries change.
+       The first message carries the credentials and the client's revision'''
+    heartbeat = float(config['push_heartbeat'])
+    ws = web.WebSocketResponse(heartbeat=heartbeat)
+    await ws.prepare(request)
+    try:
+        data = await ws.receive_json(loads=loads, timeout=heartbeat)
+        since = int(data.get('revision') or 0)
+        authenticated = await user_manager.auth_user(data['username'], data['token'])
+    except (TypeError, ValueError, KeyError, AttributeError, asyncio.TimeoutError):
+        authenticated = False
+    if not authenticated:
+        LOGGER.debug('Subscription denied')
+        await ws.send_json(dict(success=False, msg='Access Denied'), dumps=dumps)
+        await ws.close()
+        return ws
+    LOGGER.info(f"[{data['username']}] subscribed to the dashboard")
+    pusher = asyncio.ensure_future(push_dashboard(ws, data['username'], since))
+    async for msg in ws:
+        pass  # reading keeps the heartbeat going until the client disconnects
+    pusher.cancel()
+    LOGGER.info(f"[{data['username']}] unsubscribed from the dashboard")
+    return ws
+
+
+async def push_dashboard(ws:web.WebSocketResponse, username:str, since:int):
+    try:
+        async for res in user_manager.watch_dashboard(username, since):
+            await ws.send_json(res, dumps=dumps)
+    except ConnectionResetError:
+        pass
+    await ws.close()
 
 
-@require_login
 async def add_query_to_dashboard(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.add_query(data['username'], data)
-    return web.json_response(dict(success=res, msg=msg))
+    data = request['data']
+    res, msg = await user_manager.add_query(request['username'], data)
+    return json_response(dict(success=res, msg=msg))
 
 
 async def login_user(request:web.Request):
-    data = await request.json()
+    data = request['data']
     username, password = data['username'], data['password']
     auth_success, token = await user_manager.login(username, password)
     res = dict(
@@ -47,94 +114,83 @@ async def login_user(request:web.Request):
         token = token,
         auth_success = auth_success
     )
-    return web.json_response(res)
+    return json_response(res)
 
 
-@require_login
 async def save_queries(request:web.Request):
-    data = await request.json()
-    success, msg = await user_manager.save_dashboard(data['username'])
-    return web.json_response(dict(success=success, msg=msg))
+    success, msg = await user_manager.save_dashboard(request['username'])
+    return json_response(dict(success=success, msg=msg))
 
 
-@require_login
 async def clean_completed(request:web.Request):
-    data = await request.json()
-    await user_manager.remove_completed_queries(data['username'])
-    return web.json_response(dict(success=True, msg='Completed Queries were removed'))
+    await user_manager.remove_completed_queries(request['username'])
+    return json_response(dict(success=True, msg='Completed Queries were removed'))
 
 
-@require_login
 async def delete_query(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.delete_query(data['username'], data['uid'])
-    return web.json_response(dict(success=res, msg=msg))
+    data = request['data']
+    res, msg = await user_manager.delete_query(request['username'], data['uid'])
+    return json_response(dict(success=res, msg=msg))
     
 
-@require_login
 async def get_query(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.get_query(data['username'], data['uid'])
+    data = request['data']
+    res, msg = await user_manager.get_query(request['username'], data['uid'])
     res = serialize({'success': res, **msg})
-    return web.json_response(res)
+    return json_response(res)
     
     
-@require_login
 async def get_all_queries(request:web.Request):
-    data = await request.json()
-    res = await user_manager.get_all_queries(data['username'])
-    res = {k:serialize(v) for k, v in res.items()}
-    return web.json_response(res)
+    res = await user_manager.get_all_queries(request['username'])
+    return json_response(res)
+
+
+async def get_stats(request:web.Request):
+    res = await user_manager.get_stats(request['username'])
+    return json_response(res)
 
 
-@require_login
 async def edit_query(request:web.Request):
-    data = await request.json()
-    s, msg = await user_manager.edit_query(data['username'], data)
-    return web.json_response(dict(success=s, msg=msg))
+    data = request['data']
+    s, msg = await user_manager.edit_query(request['username'], data)
+    return json_response(dict(success=s, msg=msg))
 
 
-@require_login
 async def refresh_data(request:web.Request):
     # Update cookies files and reload queries from source
-    data = await request.json()
-    await user_manager.reload_cookies(data['username'], data['cookies'])
+    data = request['data']
+    await user_manager.reload_cookies(request['username'], data['cookies'])
     # await user_manager.populate_monitor(username)
-    return web.json_response(dict(success=True, msg='Data successfuly refreshed'))
+    return json_response(dict(success=True, msg='Data successfuly refreshed'))
 
 
-@require_login
 async def get_sound_file(request:web.Request):
-    data = await request.json()
-    f, fname = await user_manager.get_sound_file(data['username'], data['alert_sound'])
+    data = request['data']
+    f, fname = await user_manager.get_sound_file(request['username'], data['alert_sound'])
     return web.Response(body=f, headers={'CONTENT-DISPOSITION': fname})
     
 
-@require_login
 async def reload_config(request:web.Request):
-    data = await request.json()
+    data = request['data']
     if data['passphrase'] == 'n9FQm0zcv$@SA':
         res = await user_manager.reload_config(data)
         res = dict(success=True, msg='Servers config file reloaded')
     else:
         res = dict(success=False, msg='Access Denied')
-    return web.json_response(res)
+    return json_response(res)
     
 
 async def ping(request:web.Request):
     LOGGER.info('Received ping')
-    return web.json_response(dict(success=True))
+    return json_response(dict(success=True))
 
 
-@require_login
 async def get_settings(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.get_settings(data['username'])
-    return web.json_response(dict(success=res, **msg))
+    res, msg = await user_manager.get_settings(request['username'])
+    return json_response(dict(success=res, **msg))
 
 
-@require_login
 async def edit_settings(request:web.Request):
-    data = await request.json()
-    res, msg = await user_manager.edit_settings(data['username'], data)
-    return web.json_response(dict(success=res, msg=msg))
+    data = request['data']
+    res, msg = await user_manager.edit_settings(request['username'], data)
+    return json_response(dict(success=res, msg=msg))
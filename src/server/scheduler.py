@@ -0,0 +1,72 @@
+import heapq
+from itertools import count
+from datetime import datetime
+
+
+class Scheduler:
+    '''Min-heap of Query uids keyed on the time at which they are due'''
+
+    def __init__(self):
+        self.heap = list()     # entries: [due, seq, uid]
+        self.entries = dict()  # uid: entry
+        self.counter = count()  # tie-breaker, keeps FIFO order for equal due times
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, uid):
+        return uid in self.entries
+
+    def push(self, uid, due:datetime):
+        '''(Re)key the uid. If due is None, the uid is removed from the schedule'''
+        self.remove(uid)
+        if due is None: return
+        entry = [due, next(self.counter), uid]
+        self.entries[uid] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, uid):
+        '''Invalidate the entry in place - it's discarded once it reaches the top of the heap'''
+        entry = self.entries.pop(uid, None)
+        if entry is not None:
+            entry[-1] = None
+            if len(self.heap) > 2*len(self.entries)+32:
+                self._compact()
+
+    def _compact(self):
+        self.heap = [e for e in self.heap if e[-1] is not None]
+        heapq.heapify(self.heap)
+
+    def peek(self) -> datetime:
+        '''returns the earliest due time or None if nothing is scheduled'''
+        while self.heap and self.heap[0][-1] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def upcoming(self, until:datetime) -> list:
+        '''returns uids that become due before the given time in due order, without removing them.
+           Only the part of the heap that is due before that time is visited'''
+        res = list()
+        frontier = [(self.heap[0], 0)] if self.heap and self.heap[0][0] <= until else []
+        while frontier:
+            entry, i = heapq.heappop(frontier)
+            if entry[-1] is not None:
+                res.append(entry[-1])
+            for child in (2*i+1, 2*i+2):
+                if child < len(self.heap) and self.heap[child][0] <= until:
+                    heapq.heappush(frontier, (self.heap[child], child))
+        return res
+
+    def pop_due(self, now:datetime) -> list:
+        '''Remove and return uids that are due at the given time'''
+        due = list()
+        while self.heap and (self.heap[0][-1] is None or self.heap[0][0] <= now):
+            uid = heapq.heappop(self.heap)[-1]
+            if uid is not None:
+                del self.entries[uid]
+                due.append(uid)
+        return due
+
+    def clear(self):
+        self.heap.clear()
+        self.entries.clear()
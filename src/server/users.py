@@ -1,12 +1,16 @@
 from aiohttp import web
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
+import traceback
 from common.utils import boolinize
 from server.utils import singleton, gen_token
 from server import config
 from server.db_conn import db_connection
 from server.monitor import Monitor
+from server.fetch import fetcher
+from server.retries import retry_budget
+from server.codec import loads, json_response
 import server.query
 
 
@@ -20,6 +24,8 @@ class UserManager:
     def __init__(self):
         self.db_conn = db_connection()  # TODO replace with an authentication service
         self.sessions = dict()
+        self.wakeup = asyncio.Event()  # set when queries are modified and need to be re-scheduled
+        self.prewarming:asyncio.Task = None
 
 
     async def run(self):
@@ -32,6 +38,47 @@ class UserManager:
             await asyncio.sleep(i)
 
 
+    async def run_monitors(self):
+        '''Continuously runs due queries of all users in the background'''
+        tick = float(config['scheduler_tick'])
+        while True:
+            self.wakeup.clear()
+            retry_budget.reset()
+            users = list(self.sessions.keys())
+            monitors = [self.sessions[user]['monitor'] for user in users]
+            results = await asyncio.gather(*(m.scan() for m in monitors), return_exceptions=True)
+            for user, res in zip(users, results):
+                if isinstance(res, Exception):
+                    LOGGER.error(f"[{user}] background scan failed: {''.join(traceback.format_exception(res))}")
+            lead = timedelta(seconds=float(config['prewarm_lead']))
+            self._prewarm(monitors, datetime.now()+lead)
+            next_due = min((d for d in (m.schedule.peek() for m in monitors) if d is not None), default=None)
+            secs = tick if next_due is None else (next_due-datetime.now()).total_seconds()
+            # wake up in time to pre-warm the hosts of the next due queries
+            if secs > lead.total_seconds(): secs -= lead.total_seconds()
+            # Queries that lost connection are due immediately, so don't spin faster than once per second
+            timeout = min(max(secs, 1), tick)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    def _prewarm(self, monitors:list, until:datetime):
+        '''pre-warms hosts of the queries due before the given time, unless the previous pre-warm is still running'''
+        if self.prewarming is not None and not self.prewarming.done():
+            return
+        upcoming = {m.queries[uid]['url'] for m in monitors for uid in m.schedule.upcoming(until) if uid in m.queries}
+        if upcoming:
+            self.prewarming = asyncio.ensure_future(fetcher.prewarm(upcoming))
+            self.prewarming.add_done_callback(self._prewarmed)
+
+
+    def _prewarmed(self, task:asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error(f"Pre-warm failed: {''.join(traceback.format_exception(task.exception()))}")
+
+
     async def register_new_user(self, username:str, password:str):
         await self.db_conn.create_new_user(username, password)
 
@@ -49,6 +96,7 @@ class UserManager:
     async def login(self, username:str, password:str):
         '''Run UserManager on first user login'''
         asyncio.ensure_future(self.run(), loop=asyncio.get_event_loop())
+        asyncio.ensure_future(self.run_monitors(), loop=asyncio.get_event_loop())
         self.login = self.__login
         return await self.login(username, password)
 
@@ -75,9 +123,30 @@ class UserManager:
 
     async def populate_monitor(self, username:str):
         s, msg = await self.sessions[username]['monitor'].populate()
+        self.wakeup.set()
         return s, msg
 
 
+    async def get_dashboard(self, username:str, since:int=None) -> tuple[dict, str]:
+        return await self.sessions[username]['monitor'].get_snapshot(since)
+
+
+    async def get_dashboard_revision(self, username:str) -> int:
+        revision, msg = await self.sessions[username]['monitor'].get_revision()
+        return revision
+
+
+    async def watch_dashboard(self, username:str, since:int=0):
+        '''yields dashboard deltas as soon as the snapshot changes, until the user is logged out'''
+        while username in self.sessions:
+            monitor = self.sessions[username]['monitor']
+            res, msg = await monitor.get_snapshot(since)
+            if res['full'] or res['queries'] or res['removed']:
+                yield res
+            since = res['revision']
+            await monitor.wait_for_update(since, float(config['push_heartbeat']))
+
+
     async def reload_cookies(self, username:str, cookies:dict):
         return await self.sessions[username]['monitor'].reload_cookies(cookies)
 
@@ -94,11 +163,13 @@ class UserManager:
     async def remove_completed_queries(self, username):
         LOGGER.info(f'Removing queries for user: {username}')
         await self.sessions[username]['monitor'].clean_queries()
+        self.wakeup.set()
 
     
     async def delete_query(self, username, uid) -> tuple[bool, str]:
         try:
             res, msg = await self.sessions[username]['monitor'].delete_query(uid)
+            self.wakeup.set()
             return res, msg
         except KeyError:
             return False, 'Requested query does not exist'
@@ -114,13 +185,18 @@ class UserManager:
         return res, msg
 
     async def get_all_queries(self, username) -> dict:
-        res = self.sessions[username]['monitor'].queries
+        res, msg = await self.sessions[username]['monitor'].get_all_queries()
         LOGGER.debug(f'[{username}] returning all {len(res)} queries')
         return res
 
+    async def get_stats(self, username) -> dict:
+        '''returns fetch statistics of each query'''
+        return {uid:dict(q['query'].stats) for uid, q in self.sessions[username]['monitor'].queries.items()}
+
     async def edit_query(self, username, data):
         res, msg = await self.sessions[username]['monitor'].edit_query(data)
         if res:
+            self.wakeup.set()
             LOGGER.info(f"[{username}] edited Query: {data['alias']}")
         else:
             LOGGER.warning(f"[{username}] failed to edit Query: {data['alias']}. Reason: {msg}")
@@ -141,6 +217,7 @@ class UserManager:
     async def add_query(self, username, data) -> tuple[bool, dict]:
         res, msg = await self.sessions[username]['monitor'].add_query(data)
         if res:
+            self.wakeup.set()
             LOGGER.info(f"[{data['username']}] added Query {data['url']}")
         return res, msg
 
@@ -163,18 +240,28 @@ async def _get_auth(data:dict) -> tuple:
         username = data['username']
         auth = await user_manager.auth_user(username, data['token'])
         return username, auth
-    except KeyError:
+    except (KeyError, TypeError):
         return 'Unknown User', False
 
-def require_login(func):
-    async def wrapper(*args, **kw):
-        data = await args[0].json()
+PUBLIC_ROUTES = {'/auth'}  # POST routes that don't require a session
+
+@web.middleware
+async def auth_middleware(request:web.Request, handler):
+    '''Decodes the JSON body of POST requests once into request['data'] and,
+       unless the route is public, authenticates the session into request['username']'''
+    if request.method != 'POST':
+        return await handler(request)
+    try:
+        data = loads(await request.read())
+    except ValueError:
+        return json_response(dict(success=False, msg='Invalid request'), status=400)
+    request['data'] = data
+    if request.path not in PUBLIC_ROUTES:
         username, authenticated = await _get_auth(data)
-        if authenticated:
-            LOGGER.debug(f"[{username}] responding to request {func.__name__} with args: {data}")
-            return await func(*args, **kw)
-        else:
+        if not authenticated:
             LOGGER.debug(f"[{username}] Access Denied")
-            return web.json_response(dict(success=False, msg='Access Denied'))
-    return wrapper
+            return json_response(dict(success=False, msg='Access Denied'))
+        LOGGER.debug(f"[{username}] responding to request {request.path} with args: {data}")
+        request['username'] = username
+    return await handler(request)
 
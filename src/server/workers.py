@@ -0,0 +1,39 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from server.utils import singleton
+from server import config
+
+LOGGER = logging.getLogger('Workers')
+
+
+@singleton
+class WorkerPool:
+    '''Long-lived thread pool for CPU-bound work, shared by all Monitors'''
+
+    def __init__(self):
+        self.size = int(config['worker_pool_size'])
+        self.user_quota = int(config['worker_user_quota'])
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='Worker')
+        self.quotas = dict()  # username: asyncio.Semaphore
+
+    def quota(self, username:str) -> asyncio.Semaphore:
+        '''Limits how many Queries of a single user may be processed at once,
+           so that one large dashboard cannot starve the others. It is held for the whole
+           Query.run, so it bounds the user's concurrent requests too, not only the pooled work'''
+        try:
+            return self.quotas[username]
+        except KeyError:
+            self.quotas[username] = asyncio.Semaphore(self.user_quota)
+            return self.quotas[username]
+
+    async def submit(self, func, *args):
+        '''Run func in the pool without blocking the event loop'''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        LOGGER.info('Worker pool shut down')
+
+
+worker_pool = WorkerPool()
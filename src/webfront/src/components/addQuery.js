@@ -38,6 +38,11 @@ class AddQueryFormAccept extends React.Component {
         query_data['alert_sound'] = event.target.alert_sound.value
         query_data['min_matches'] = event.target.min_matches.value
         query_data['cooldown'] = event.target.cooldown.value
+        query_data['parser'] = event.target.parser.value
+        query_data['connect_timeout'] = event.target.connect_timeout.value
+        query_data['read_timeout'] = event.target.read_timeout.value
+        query_data['adaptive'] = event.target.adaptive.value
+        query_data['max_interval'] = event.target.max_interval.value
         let resp = await addQuery(this.props.username, this.props.token, query_data)
         this.props.querySubmitSetter(true, resp['msg'])
     }
@@ -60,6 +65,11 @@ class AddQueryFormAccept extends React.Component {
                         <Row><Form.Label className='addQuery-label' column>*Sound</Form.Label><Form.Control className="addQuery-input" type="text" name="alert_sound" placeholder='Default'/></Row>
                         <Row><Form.Label className='addQuery-label' column>*Min matches</Form.Label><Form.Control className="addQuery-input" type="text" name="min_matches" defaultValue='1'/></Row>
                         <Row><Form.Label className='addQuery-label' column>*Cooldown</Form.Label><Form.Control className="addQuery-input" type="text" name="cooldown" defaultValue='0'/></Row>
+                        <Row><Form.Label className='addQuery-label' column>*Parser</Form.Label><Form.Control className="addQuery-input" type="text" name="parser" placeholder='Default'/></Row>
+                        <Row><Form.Label className='addQuery-label' column>*Connect timeout</Form.Label><Form.Control className="addQuery-input" type="text" name="connect_timeout" placeholder='Default'/></Row>
+                        <Row><Form.Label className='addQuery-label' column>*Read timeout</Form.Label><Form.Control className="addQuery-input" type="text" name="read_timeout" placeholder='Default'/></Row>
+                        <Row><Form.Label className='addQuery-label' column>*Adaptive</Form.Label><Form.Control className="addQuery-input" type="text" name="adaptive" defaultValue='false'/></Row>
+                        <Row><Form.Label className='addQuery-label' column>*Max interval</Form.Label><Form.Control className="addQuery-input" type="text" name="max_interval" placeholder='Default'/></Row>
                     </Form.Group>
                     <Button className="addQuery-submit" variant="primary" type="submit">
                         Add Query
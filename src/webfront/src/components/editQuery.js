@@ -34,6 +34,11 @@ class EditQueryFormSelected extends React.Component {
         query_data['alert_sound'] = event.target.alert_sound.value
         query_data['min_matches'] = event.target.min_matches.value
         query_data['cooldown'] = event.target.cooldown.value
+        query_data['parser'] = event.target.parser.value
+        query_data['connect_timeout'] = event.target.connect_timeout.value
+        query_data['read_timeout'] = event.target.read_timeout.value
+        query_data['adaptive'] = event.target.adaptive.value
+        query_data['max_interval'] = event.target.max_interval.value
         let resp = await editQuery(this.props.username, this.props.token, query_data)
         this.props.setQueryEdited(true, resp['msg'])
     }
@@ -59,6 +64,11 @@ class EditQueryFormSelected extends React.Component {
                 <Row><Form.Label className='editQuery-label' column>Sound</Form.Label><Form.Control className="editQuery-input" type="text" name="alert_sound" placeholder='Default' defaultValue={data['alert_sound']}/></Row>
                 <Row><Form.Label className='editQuery-label' column>Min matches</Form.Label><Form.Control className="editQuery-input" type="text" name="min_matches" defaultValue={data['min_matches']}/></Row>
                 <Row><Form.Label className='editQuery-label' column>Cooldown</Form.Label><Form.Control className="editQuery-input" type="text" name="cooldown" defaultValue={data['cooldown']}/></Row>
+                <Row><Form.Label className='editQuery-label' column>Parser</Form.Label><Form.Control className="editQuery-input" type="text" name="parser" defaultValue={data['parser']}/></Row>
+                <Row><Form.Label className='editQuery-label' column>Connect timeout</Form.Label><Form.Control className="editQuery-input" type="text" name="connect_timeout" placeholder='Default' defaultValue={data['connect_timeout']}/></Row>
+                <Row><Form.Label className='editQuery-label' column>Read timeout</Form.Label><Form.Control className="editQuery-input" type="text" name="read_timeout" placeholder='Default' defaultValue={data['read_timeout']}/></Row>
+                <Row><Form.Label className='editQuery-label' column>Adaptive</Form.Label><Form.Control className="editQuery-input" type="text" name="adaptive" defaultValue={data['adaptive']}/></Row>
+                <Row><Form.Label className='editQuery-label' column>Max interval</Form.Label><Form.Control className="editQuery-input" type="text" name="max_interval" defaultValue={data['max_interval']}/></Row>
             </Form.Group>
             <Button className="editQuery-submit" variant="primary" type="submit">
                 Edit Query
@@ -1,6 +1,6 @@
 import Table from 'react-bootstrap/Table';
 import '../static/monitor.css';
-import { getDashboard, getSound } from '../db_conn';
+import { getDashboardDelta, getSound } from '../db_conn';
 import React from 'react';
 
 
@@ -19,19 +19,30 @@ export default class Monitor extends React.Component{
             '0': 'OK',
             '1': 'Access Denied',
             '2': 'Connection Lost',
+            '3': 'Timed Out',
         }
         }
+        this.dashboard = {}
+        this.revision = 0
+    }
+
+    applyDelta(delta){
+        if (delta['revision'] === undefined) return
+        if (delta['full']) this.dashboard = {}
+        Object.assign(this.dashboard, delta['queries'])
+        delta['removed'].forEach(uid => delete this.dashboard[uid])
+        this.revision = delta['revision']
     }
 
     async getContent(){
-        let d = await getDashboard(this.props.username, this.props.token);
+        let d = this.dashboard
         let b = []
         Object.keys(d).forEach(async function(q) {
             if ( parseInt(d[q]['cycles_limit'])>=0 ){
                 let n = await this.getNotificationSign(d[q]['found'], d[q]['is_new'])
                 let c = (d[q]['found'] && d[q]['is_recurring']) ? d[q]['cooldown'] : ''
                 let r = (d[q]['is_recurring']) ? 'True' : ''
-                let status_ = this.state.QSTAT_CODES[d[q]['status']]
+                let status_ = d[q]['host_status'] || this.state.QSTAT_CODES[d[q]['status']]
                 b.push(<tr key={d[q]['uid']}>
                     <td><a href={d[q]['target_url']} target="_blank" rel="noreferrer">{d[q]['alias']}</a></td>
                     <td>{n}</td>
@@ -72,23 +83,46 @@ export default class Monitor extends React.Component{
         a.start()
     }
     
-    async updateTable() {
+    async updateTable(delta) {
+        this.applyDelta(delta)
         this.setState({ 
             content: await this.getContent(),
             last_run: new Date().toLocaleTimeString('en-GB'),
         })
     }
 
-    async componentDidMount() {
-        if (this.props.isLoggedIn)  {
-            await this.updateTable()
+    async pollTable() {
+        await this.updateTable(await getDashboardDelta(this.props.username, this.props.token, this.revision))
+    }
+
+    subscribe() {
+        // the server pushes changes of the dashboard, polling is used only if the channel is closed
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+        this.ws = new WebSocket(`${protocol}//${window.location.host}/subscribe`)
+        this.ws.onopen = () => {
+            this.ws.send(JSON.stringify({'username': this.props.username, 'token': this.props.token, 'revision': this.revision}))
+        }
+        this.ws.onmessage = async (event) => {
+            await this.updateTable(JSON.parse(event.data))
+        }
+        this.ws.onclose = () => {
+            if (this.unmounted || this.interval) return
             this.interval = setInterval(async () => {
-                this.updateTable()
+                this.pollTable()
             }, this.state.refresh_rate*1000);
         }
+    }
+
+    async componentDidMount() {
+        if (this.props.isLoggedIn)  {
+            await this.pollTable()
+            this.subscribe()
+        }
      }
 
     async componentWillUnmount() {
+        this.unmounted = true
+        if (this.ws) this.ws.close()
         clearInterval(this.interval);
       }
 
@@ -22,6 +22,20 @@ export async function getDashboard(username, token) {
     return data
 }
 
+export async function getDashboardDelta(username, token, revision) {
+    let data = {};
+    let res = await fetch('/get_dashboard_delta', {
+                method: 'POST',
+                body: JSON.stringify({'username': username, 'token': token, 'revision': revision}),
+                })
+    try {
+        data = await res.json();
+    } catch (error){
+        console.error(error)
+    }
+    return data
+}
+
 export async function getAllQueries(username, token) {
     let data = {};
     let res = await fetch('/get_all_queries', {
@@ -3,13 +3,15 @@ import server.query
 Query = server.query.Query
 import server.monitor
 Monitor = server.monitor.Monitor
+from server.scheduler import Scheduler
 
 class fake_query:
     def __init__(self, *args, **kwargs) -> None:
         self.url = kwargs.get('url', 'empty-url')
         self.re_compilers = kwargs.get('sequence', 'empty-compilers')
         self.min_matches = kwargs.get('min_matches', 1)
-    def run(self):
+        self.stats = dict(runs=0, parsed=0, not_modified=0, unchanged=0)
+    async def run(self):
         return False, 0
     def dump_page_content(self):
         pass
@@ -21,6 +23,8 @@ class fake_monitor:
     def __init__(self, username) -> None:
         self.username = username
         self.queries = dict()
+        self.schedule = Scheduler()
+        self.revision = 0
     async def add_query(self, d):
         return True, 'Query added successfully'
     async def edit_query(self, d):
@@ -29,6 +33,14 @@ class fake_monitor:
         return True, f'Query restored: {d["alias"]}'
     async def scan(self):
         return dict(), 'Scanned Queries'
+    async def get_snapshot(self, since=None):
+        return dict(), 'Returned latest scan results'
+    async def wait_for_update(self, since, timeout=None):
+        return False, 'No changes'
+    async def get_revision(self):
+        return self.revision, 'Returned the dashboard revision'
+    async def get_all_queries(self):
+        return dict(), 'Returned all queries'
     async def clean_queries(self):
         return True, ''
     async def close_session(self):
@@ -0,0 +1,60 @@
+import json
+import zlib
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from aiohttp import web
+
+from server.utils import config
+from server.codec import compression_middleware, etag_matches, json_response, loads, COMPRESSORS
+
+
+class fake_webrequest:
+    def __init__(self, headers:dict):
+        self.headers = headers
+
+
+class Test_Codec(IsolatedAsyncioTestCase):
+
+    async def compress(self, data, headers:dict, min_size:str='100') -> web.Response:
+        async def handler(request): return json_response(data, headers={'ETag': '"abc"'})
+        with patch.dict(config.config, compress_min_size=min_size):
+            return await compression_middleware(fake_webrequest(headers), handler)
+
+
+    async def test_loads_dumps(self):
+        for codec in ('json', 'orjson'):
+            with patch.dict(config.config, json_codec=codec):
+                self.assertEqual(loads(json_response({'a':[1, None]}).body), {'a':[1, None]})
+                with self.assertRaises(ValueError):
+                    loads(b'{not json')
+
+
+    async def test_compress_gzip(self):
+        '''large responses are compressed and get an ETag of their encoding'''
+        data = {str(i):'x'*10 for i in range(100)}
+        res = await self.compress(data, {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['ETag'], '"abc-gzip"')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(json.loads(zlib.decompress(res.body, 16+zlib.MAX_WBITS)), data)
+
+
+    async def test_compress_skipped(self):
+        '''small responses and clients that don't accept any encoding get the body as is'''
+        data = {str(i):'x'*10 for i in range(100)}
+        res = await self.compress({'a':1}, {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = await self.compress(data, {'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.headers['ETag'], '"abc"')
+        res = await self.compress(data, {})
+        self.assertEqual(json.loads(res.body), data)
+
+
+    async def test_etag_matches(self):
+        self.assertTrue(etag_matches(fake_webrequest({'If-None-Match': '"abc"'}), '"abc"'))
+        self.assertTrue(etag_matches(fake_webrequest({'If-None-Match': '"xyz", "abc-gzip"'}), '"abc"'))
+        self.assertFalse(etag_matches(fake_webrequest({'If-None-Match': '"abd"'}), '"abc"'))
+        self.assertFalse(etag_matches(fake_webrequest({}), '"abc"'))
+        if 'br' in COMPRESSORS:
+            self.assertTrue(etag_matches(fake_webrequest({'If-None-Match': '"abc-br"'}), '"abc"'))
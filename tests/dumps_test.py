@@ -0,0 +1,90 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from server.dumps import page_dumper
+
+
+class Test_PageDumper(TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path, self.objects, self.size, self.refs = page_dumper.path, page_dumper.objects, page_dumper.size, page_dumper.refs
+        self.history, self.max_size = page_dumper.history, page_dumper.max_size
+        page_dumper.path = self.dir.name
+        page_dumper.objects = os.path.join(self.dir.name, 'objects')
+        page_dumper.size, page_dumper.refs = None, None
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.flush()
+        page_dumper.path, page_dumper.objects, page_dumper.size, page_dumper.refs = self.path, self.objects, self.size, self.refs
+        page_dumper.history, page_dumper.max_size = self.history, self.max_size
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def flush(self):
+        page_dumper.executor.submit(lambda: None).result()
+
+
+    def test_identical_pages_stored_once(self):
+        '''index keeps every dump, content is stored once per digest'''
+        page_dumper.submit('https://a.com/x', 'hello')
+        page_dumper.submit('https://a.com/x', 'hello')
+        page_dumper.submit('https://b.com', 'hello')
+        self.flush()
+        self.assertEqual(len(os.listdir(page_dumper.objects)), 1)
+        with open(os.path.join(self.dir.name, 'https_a_com_x.idx')) as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+        self.assertEqual(page_dumper.load('https://b.com'), 'hello')
+
+
+    def test_bounded_history(self):
+        page_dumper.history = 3
+        for i in range(5):
+            page_dumper.submit('https://a.com', f'page {i}')
+        self.flush()
+        self.assertEqual(page_dumper.load('https://a.com', 0), 'page 2')
+        self.assertEqual(page_dumper.load('https://a.com'), 'page 4')
+
+
+    def test_rotation(self):
+        '''oldest pages are removed once dump_max_size is exceeded'''
+        page_dumper.max_size = 200
+        for i in range(10):
+            page_dumper.submit(f'https://a.com/{i}', os.urandom(50).hex())
+        self.flush()
+        self.assertLessEqual(page_dumper._get_size(), 200)
+        self.assertGreater(len(os.listdir(page_dumper.objects)), 0)
+        for name in os.listdir(self.dir.name):
+            if name.endswith('.idx'):
+                with open(os.path.join(self.dir.name, name)) as f:
+                    for line in f.read().splitlines():
+                        self.assertTrue(os.path.exists(os.path.join(page_dumper.objects, f'{line.split()[-1]}.lz4')))
+        self.assertIsNone(page_dumper.load('https://a.com/0'))
+
+
+    def test_trimmed_objects_removed(self):
+        '''pages trimmed from the history are removed unless another index refers to them'''
+        page_dumper.history = 2
+        page_dumper.submit('https://b.com', 'page 0')
+        for i in range(3):
+            page_dumper.submit('https://a.com', f'page {i}')
+        self.flush()
+        page_dumper.size, page_dumper.refs = None, None  # references are counted again after a restart
+        page_dumper.submit('https://a.com', 'page 3')
+        self.flush()
+        self.assertEqual(len(os.listdir(page_dumper.objects)), 3)
+        self.assertEqual(page_dumper.load('https://a.com', 0), 'page 2')
+        self.assertEqual(page_dumper.load('https://b.com'), 'page 0')
+        self.assertEqual(page_dumper.size, page_dumper._get_size())
+
+
+    def test_load_missing(self):
+        self.assertIsNone(page_dumper.load('https://a.com'))
+        page_dumper.submit('https://a.com', 'hello')
+        self.flush()
+        self.assertIsNone(page_dumper.load('https://a.com', 1))
+        for name in os.listdir(page_dumper.objects):
+            os.remove(os.path.join(page_dumper.objects, name))
+        self.assertIsNone(page_dumper.load('https://a.com'))
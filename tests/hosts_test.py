@@ -0,0 +1,64 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import datetime, timedelta
+
+from server.hosts import TokenBucket, CircuitBreaker, get_host
+
+
+class Test_Hosts(TestCase):
+
+    def test_get_host(self):
+        self.assertEqual(get_host('https://WWW.Example.com:8080/a?b=c'), 'www.example.com')
+        self.assertEqual(get_host(None), '')
+
+
+    def test_token_bucket_reserve(self):
+        '''burst is allowed at once, further requests are spread by the rate'''
+        bucket = TokenBucket(rate=2, burst=2)
+        delays = [bucket.reserve() for _ in range(4)]
+        self.assertEqual(delays[:2], [0, 0])
+        self.assertAlmostEqual(delays[2], 0.5, delta=0.01)
+        self.assertAlmostEqual(delays[3], 1, delta=0.01)
+
+
+    def test_breaker_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, backoff=60, max_backoff=3600)
+        self.assertFalse(breaker.record(False))
+        self.assertEqual(breaker.allow('a'), 0)
+        self.assertTrue(breaker.record(False))
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertGreaterEqual(breaker.allow('a'), 29)
+        self.assertTrue(breaker.describe().startswith('Backoff'))
+
+
+    def test_breaker_success_resets(self):
+        breaker = CircuitBreaker(threshold=2, backoff=60, max_backoff=3600)
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+
+    def test_breaker_half_open_probe(self):
+        '''a single probe is let through once the backoff expires'''
+        breaker = CircuitBreaker(threshold=1, backoff=60, max_backoff=3600)
+        breaker.record(False)
+        breaker.retry_at = datetime.now() - timedelta(seconds=1)
+        self.assertEqual(breaker.allow('probe'), 0)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertGreater(breaker.allow('other'), 0)
+        self.assertEqual(breaker.allow('probe'), 0)
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.allow('other'), 0)
+
+
+    def test_breaker_exponential_backoff(self):
+        '''failed probe doubles the backoff, up to max_backoff'''
+        breaker = CircuitBreaker(threshold=1, backoff=60, max_backoff=200)
+        with patch('server.hosts.random.uniform', lambda a, b: b):
+            for expected in (60, 120, 200, 200):
+                breaker.state = breaker.HALF_OPEN
+                start = datetime.now()
+                breaker.record(False)
+                self.assertAlmostEqual((breaker.retry_at - start).total_seconds(), expected, delta=0.1)
@@ -1,12 +1,15 @@
+import asyncio
 import logging
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import Mock, MagicMock, AsyncMock
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
 from datetime import datetime, timedelta
 
 from . import Monitor
 from server.query import serialize
 from common import *
 from server.utils import config
+from server.hosts import host_limiter, host_breakers
+from server.workers import worker_pool
 
 
 log = logging.getLogger('TEST')
@@ -24,6 +27,14 @@ class Test_Monitor(IsolatedAsyncioTestCase):
 
     def setUp(self) -> None:
         self.monitor.queries.clear()
+        self.monitor.schedule.clear()
+        self.monitor.last_ran.clear()
+        self.monitor.host_slots.clear()
+        self.monitor.backoff.clear()
+        for state in (self.monitor.snapshot, self.monitor.dirty, self.monitor.changelog, self.monitor.removed):
+            state.clear()
+        host_limiter.buckets.clear()
+        host_breakers.breakers.clear()
         self.monitor.warnings.clear()
         super().setUp()
     
@@ -160,6 +171,40 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         c = self.monitor._eta_condition(eta, datetime(2023, 4, 25, 2, 25))
         self.assertTrue(c)
 
+    async def test_unit_eta_next_window_1(self):
+        '''next window opens on the next matching dow and time_span'''
+        eta = await self.monitor._parse_eta('saturday,16-18')
+        self.assertEqual(eta.next_window(datetime(2023, 4, 25, 15, 34)), datetime(2023, 4, 29, 16, 0))
+        self.assertEqual(eta.next_window(datetime(2023, 4, 29, 17, 0)), datetime(2023, 4, 29, 17, 0))
+        self.assertEqual(eta.next_window(datetime(2023, 4, 29, 18, 1)), datetime(2023, 5, 6, 16, 0))
+
+    async def test_unit_eta_next_window_2(self):
+        '''next window is None when all dates have passed'''
+        eta = await self.monitor._parse_eta('14/11/2023,20-23')
+        self.assertEqual(eta.next_window(datetime(2023, 11, 1, 12, 0)), datetime(2023, 11, 14, 20, 0))
+        self.assertIsNone(eta.next_window(datetime(2023, 11, 14, 23, 1)))
+        eta = await self.monitor._parse_eta('3/9/2023-14/11/2023,monday-friday')
+        self.assertEqual(eta.next_window(datetime(2023, 9, 1, 12, 0)), datetime(2023, 9, 4, 0, 0))
+        self.assertIsNone(eta.next_window(datetime(2023, 11, 16, 0, 0)))
+
+    async def test_unit_eta_next_window_3(self):
+        '''next window agrees with eta condition'''
+        eta = await self.monitor._parse_eta('monday,wednesday,0-1,22:30-24')
+        n = datetime(2023, 4, 25, 15, 34)
+        w = eta.next_window(n)
+        self.assertEqual(w, datetime(2023, 4, 26, 0, 0))
+        self.assertTrue(self.monitor._eta_condition(eta, w))
+        self.assertFalse(any(self.monitor._eta_condition(eta, n+timedelta(minutes=m)) for m in range(0, int((w-n).total_seconds()//60))))
+
+    async def test_unit_next_run_waits_for_eta(self):
+        '''query with closed ETA is keyed on the next window instead of being re-polled'''
+        d = (datetime.today()+timedelta(2)).weekday()
+        eta = await self.monitor._parse_eta(['monday','tuesday','wednesday','thursday','friday','saturday','sunday'][d])
+        due = self.monitor._next_run(dict(status=0, cycles_limit=0, eta=eta, found=False, 
+                is_recurring=False, cycles=0, last_run=datetime.now()-timedelta(10), interval=4, 
+                cooldown=0, randomize=0))
+        self.assertEqual(due, datetime.combine((datetime.today()+timedelta(2)).date(), datetime.min.time()))
+
     async def test_integration_eta_1_serialize(self):
         '''Check if serialized eta is equal to the input string'''
         d = dict(
@@ -300,6 +345,16 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         self.assertEqual(q['eta'], {'dow':[], 'dt':[], 'dow_span':[], 'dt_span':[], 'time_span':[((12,0), (13,0))], 'raw':'sorday,12-13,35-54'})
         self.assertEqual(q['cooldown'], self.monitor.MIN_INTERVAL)
 
+    async def test_unit_add_query_parser(self):
+        '''Add query with parser, fall back to the default one if not supported'''
+        await self.add_query(dict(url='localhost_p', interval=15, sequence='test_p', alias='parser_1', parser='RAW'))
+        q = await self.get_query_by_alias('parser_1')
+        self.assertEqual(q['parser'], 'raw')
+        msg = await self.add_query(dict(url='localhost_p', interval=15, sequence='test_p', alias='parser_2', parser='xyz'))
+        self.assertIn('unsupported parser: xyz', msg)
+        q = await self.get_query_by_alias('parser_2')
+        self.assertEqual(q['parser'], config['default_parser'])
+
     async def test_unit_add_query_invalid_1(self):
         '''Fail to add query without required parameters'''
         await self.add_query(dict(interval=15, sequence='test_3'), exp=False)
@@ -389,8 +444,8 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         '''perform one scan'''
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1'))
         uid = [k for k, v in self.monitor.queries.items() if v['alias']=='scan_1'][0]
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(True, 0))
-        res = self.monitor._scan_one(self.monitor.queries[uid])
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(True, 0))
+        res = await self.monitor._scan_one(self.monitor.queries[uid])
         self.assertEqual(res[uid]['cycles'], 1)
         self.assertEqual(res[uid]['found'], True)
         self.assertEqual(res[uid]['status'], 0)
@@ -401,11 +456,11 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1'))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(True, 0))
-        q = self.monitor._scan_one(q)
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(True, 0))
+        q = await self.monitor._scan_one(q)
         self.assertEqual(q[uid]['cycles'], 1)
         q[uid]['last_run'] = self.monitor.DEFAULT_DATE
-        q = self.monitor._scan_one(q[uid])
+        q = await self.monitor._scan_one(q[uid])
         self.assertEqual(q[uid]['cycles'], 1)
 
     async def test_unit_scan_one_3(self):
@@ -413,34 +468,44 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1', is_recurring=True))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(True, 0))
-        q = self.monitor._scan_one(q)
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(True, 0))
+        q = await self.monitor._scan_one(q)
         self.assertEqual(q[uid]['cycles'], 1)
         q[uid]['last_run'] = self.monitor.DEFAULT_DATE
-        q = self.monitor._scan_one(q[uid])
+        q = await self.monitor._scan_one(q[uid])
         self.assertEqual(q[uid]['cycles'], 2)
 
     async def test_unit_scan_one_4(self):
-        '''perform immediate re-scan if last query returned status: Connection Lost'''
+        '''re-scan after a growing backoff if last query returned status: Connection Lost'''
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1', is_recurring=True))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(False, 2))
-        q = self.monitor._scan_one(q)
-        self.assertEqual(q[uid]['cycles'], 0)
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(False, 0))
-        q = self.monitor._scan_one(q[uid])
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(False, 2))
+        with patch.dict(config.config, breaker_backoff='60', breaker_max_backoff='3600'):
+            q = await self.monitor._scan_one(q)
+            self.assertEqual(q[uid]['cycles'], 0)
+            retry_at = self.monitor.schedule.entries[uid][0]
+            self.assertGreater(retry_at, datetime.now() + timedelta(seconds=29))
+            self.assertLess(retry_at, datetime.now() + timedelta(seconds=61))
+            self.assertFalse(self.monitor._should_run(q[uid]))
+            self.monitor.backoff[uid] = (1, datetime.now())
+            q = await self.monitor._scan_one(q[uid])
+            self.assertGreater(self.monitor.schedule.entries[uid][0], datetime.now() + timedelta(seconds=59))
+            self.monitor.backoff[uid] = (2, datetime.now())
+            self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(False, 0))
+            q = await self.monitor._scan_one(q[uid])
         self.assertEqual(q[uid]['cycles'], 1)
+        self.assertNotIn(uid, self.monitor.backoff)
 
     async def test_unit_scan_one_5(self):
         '''ommit immediate re-scan if last query returned status: Permission Denied'''
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1', is_recurring=True))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(False, 1))
-        q = self.monitor._scan_one(q)
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(False, 1))
+        q = await self.monitor._scan_one(q)
         self.assertEqual(q[uid]['cycles'], 1)
-        q = self.monitor._scan_one(q[uid])
+        q = await self.monitor._scan_one(q[uid])
         self.assertEqual(q[uid]['cycles'], 1)
 
     async def test_unit_scan_one_6(self):
@@ -448,8 +513,8 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1', cycles_limit=-1))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(False, 0))
-        q = self.monitor._scan_one(q)
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(False, 0))
+        q = await self.monitor._scan_one(q)
         self.assertEqual(q[uid]['cycles'], 0)
 
     async def test_unit_scan_one_7(self):
@@ -457,26 +522,258 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_1'))
         q = await self.get_query_by_alias('scan_1')
         uid = q['uid']
-        self.monitor.queries[uid]['query'].run = Mock(return_value=(False, 0))
-        q = self.monitor._scan_one(q)
+        self.monitor.queries[uid]['query'].run = AsyncMock(return_value=(False, 0))
+        q = await self.monitor._scan_one(q)
         self.assertEqual(q[uid]['cycles'], 1)
         await self.edit_query(dict(uid=uid, eta='01-02-2020', last_match_datetime=self.monitor.DEFAULT_DATE))
-        q = self.monitor._scan_one(q[uid])
+        q = await self.monitor._scan_one(q[uid])
         self.assertEqual(q[uid]['cycles'], 1)
 
     async def test_unit_scan_one_8(self):
         '''ommit scan if insufficient time diff'''
         msg = await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='scan_8'))
         uid = [k for k, v in self.monitor.queries.items() if v['alias']=='scan_8'][0]
-        res = self.monitor._scan_one(self.monitor.queries[uid])
+        res = await self.monitor._scan_one(self.monitor.queries[uid])
         self.assertEqual(res[uid]['cycles'], 1)
         self.assertEqual(res[uid]['found'], False)
         self.assertEqual(res[uid]['status'], 0)
         self.assertEqual(res[uid]['is_new'], True)
-        res = self.monitor._scan_one(self.monitor.queries[uid])
+        res = await self.monitor._scan_one(self.monitor.queries[uid])
         self.assertEqual(res[uid]['cycles'], 1)
         self.assertEqual(res[uid]['is_new'], False)
 
+    async def test_scan_runs_due_only(self):
+        '''scan runs only the queries that are due and re-keys them'''
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='due_1'))
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='due_2', status=0, last_run=datetime.now()))
+        q1, q2 = await self.get_query_by_alias('due_1'), await self.get_query_by_alias('due_2')
+        q1['query'].run = AsyncMock(return_value=(False, 0))
+        q2['query'].run = AsyncMock(return_value=(False, 0))
+        await self.monitor.scan()
+        self.assertEqual(q1['query'].run.call_count, 1)
+        self.assertEqual(q2['query'].run.call_count, 0)
+        self.assertTrue(q1['is_new'])
+        self.assertGreater(self.monitor.schedule.peek(), datetime.now())
+        await self.monitor.scan()
+        self.assertEqual(q1['query'].run.call_count, 1)
+
+    async def test_scan_spreads_requests_per_host(self):
+        '''queries over the host's burst are delayed and keep their turn, others are not affected'''
+        for i in range(4):
+            await self.add_query(dict(url=f'https://example.com/{i}', interval=15, sequence='test_3', alias=f'host_{i}'))
+        await self.add_query(dict(url='https://other.com', interval=15, sequence='test_3', alias='host_other'))
+        qs = [await self.get_query_by_alias(f'host_{i}') for i in range(4)] + [await self.get_query_by_alias('host_other')]
+        for q in qs: q['query'].run = AsyncMock(return_value=(False, 0))
+        with patch.dict(config.config, host_rate='1', host_burst='2'):
+            await self.monitor.scan()
+        self.assertEqual([q['query'].run.call_count for q in qs], [1, 1, 0, 0, 1])
+        delayed = sorted(self.monitor.schedule.entries[q['uid']][0] for q in qs[2:4])
+        self.assertAlmostEqual((delayed[0]-datetime.now()).total_seconds(), 1, delta=0.5)
+        self.assertAlmostEqual((delayed[1]-delayed[0]).total_seconds(), 1, delta=0.1)
+        self.assertEqual(self.monitor.host_slots, {qs[2]['uid'], qs[3]['uid']})
+
+
+    async def test_scan_backs_off_failing_host(self):
+        '''failing host is not re-queried until the breaker lets a probe through'''
+        await self.add_query(dict(url='https://down.com/1', interval=15, sequence='test_3', alias='down_1'))
+        q = await self.get_query_by_alias('down_1')
+        q['query'].run = AsyncMock(return_value=(False, 2))
+        with patch.dict(config.config, breaker_threshold='2', breaker_backoff='60'):
+            for _ in range(3):
+                self.monitor.backoff.pop(q['uid'], None)  # only the host's breaker holds the query back
+                await self.monitor._scan_one(q)
+        self.assertEqual(q['query'].run.call_count, 2)
+        self.assertGreater(self.monitor.schedule.entries[q['uid']][0], datetime.now() + timedelta(seconds=29))
+        res, msg = await self.monitor.get_snapshot()
+        await self.monitor.scan()
+        res, msg = await self.monitor.get_snapshot()
+        self.assertTrue(res[q['uid']]['host_status'].startswith('Backoff'))
+
+
+    async def test_scan_deadline(self):
+        '''queries that miss the scan deadline are marked and re-run after a backoff'''
+        await self.add_query(dict(url='https://slow.com', interval=15, sequence='test_3', alias='slow_1', read_timeout='5'))
+        await self.add_query(dict(url='https://fast.com', interval=15, sequence='test_3', alias='fast_1'))
+        slow, fast = await self.get_query_by_alias('slow_1'), await self.get_query_by_alias('fast_1')
+        self.assertEqual(slow['read_timeout'], 5)
+        self.assertIsNone(fast['read_timeout'])
+        async def hang(): await asyncio.sleep(10)
+        slow['query'].run = AsyncMock(side_effect=hang)
+        fast['query'].run = AsyncMock(return_value=(True, 0))
+        with patch.dict(config.config, scan_deadline='0.05'):
+            await self.monitor.scan()
+        self.assertEqual(slow['status'], 3)
+        self.assertEqual(fast['status'], 0)
+        self.assertIn(slow['uid'], self.monitor.last_ran)
+        self.assertGreater(self.monitor.schedule.entries[slow['uid']][0], datetime.now())
+        self.assertIn(slow['uid'], self.monitor.backoff)
+
+
+    async def test_scan_deadline_queued(self):
+        '''queries still waiting for the user's quota at the deadline are only rescheduled'''
+        await self.add_query(dict(url='https://slow.com', interval=15, sequence='test_3', alias='slow_1'))
+        await self.add_query(dict(url='https://fast.com', interval=15, sequence='test_3', alias='fast_1'))
+        slow, fast = await self.get_query_by_alias('slow_1'), await self.get_query_by_alias('fast_1')
+        async def hang(): await asyncio.sleep(10)
+        slow['query'].run = AsyncMock(side_effect=hang)
+        fast['query'].run = AsyncMock(return_value=(True, 0))
+        status = fast['status']
+        with patch.dict(config.config, scan_deadline='0.05'), patch.dict(worker_pool.quotas, {self.monitor.username: asyncio.Semaphore(1)}):
+            await self.monitor.scan()
+            self.assertEqual(slow['status'], 3)
+            self.assertEqual(fast['status'], status)
+            fast['query'].run.assert_not_called()
+            self.assertNotIn(fast['uid'], self.monitor.last_ran)
+            self.assertEqual(host_breakers.breakers['fast.com'].failures, 0)
+            self.assertEqual(host_breakers.breakers['slow.com'].failures, 1)
+            self.assertLessEqual(self.monitor.schedule.entries[fast['uid']][0], datetime.now())
+            slow['query'].run = AsyncMock(return_value=(True, 0))
+            await self.monitor.scan()
+        self.assertEqual(fast['status'], 0)
+
+
+    async def test_scan_adaptive_interval(self):
+        '''adaptive interval stretches while the page is unchanged and shrinks when it changes'''
+        await self.add_query(dict(url='localhost_3s', interval=10, sequence='test_3', alias='adaptive_1', adaptive='true', max_interval='30'))
+        await self.add_query(dict(url='localhost_3s', interval=10, sequence='test_3', alias='adaptive_2', adaptive='true'))
+        q = await self.get_query_by_alias('adaptive_1')
+        self.assertTrue(q['adaptive'])
+        self.assertEqual(q['max_interval'], 30)
+        self.assertEqual((await self.get_query_by_alias('adaptive_2'))['max_interval'], 80)
+        q['query'].run = AsyncMock(return_value=(False, 0))
+        q['query'].changed = False
+        with patch.object(self.monitor, '_reserve_host', return_value=0):
+            for expected in (12.5, 15.625, 19.53125, 24.4140625, 30, 30):
+                q['status'] = -1
+                await self.monitor._scan_one(q)
+                self.assertEqual(self.monitor._get_interval(q), expected)
+            self.assertEqual(self.monitor._next_run(q), q['last_run'] + timedelta(minutes=30))
+            q['query'].changed = True
+            for expected in (15, 10, 10):
+                q['status'] = -1
+                await self.monitor._scan_one(q)
+                self.assertEqual(self.monitor._get_interval(q), expected)
+            q['query'].changed = None  # failed run
+            q['status'] = -1
+            await self.monitor._scan_one(q)
+            self.assertEqual(self.monitor._get_interval(q), 10)
+
+
+    async def test_get_snapshot_reports_new_once(self):
+        '''snapshot is taken by scan and new matches are reported only once'''
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='snap_1'))
+        q = await self.get_query_by_alias('snap_1')
+        q['query'].run = AsyncMock(return_value=(True, 0))
+        await self.monitor.scan()
+        res, msg = await self.monitor.get_snapshot()
+        self.assertTrue(res[q['uid']]['is_new'])
+        self.assertNotIn('query', res[q['uid']])
+        res, msg = await self.monitor.get_snapshot()
+        self.assertFalse(res[q['uid']]['is_new'])
+        self.assertFalse(q['is_new'])
+
+    async def test_get_snapshot_delta(self):
+        '''only queries changed or removed since the client's revision are returned'''
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='delta_1'))
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='delta_2'))
+        q1, q2 = await self.get_query_by_alias('delta_1'), await self.get_query_by_alias('delta_2')
+        q1['query'].run = AsyncMock(return_value=(False, 0))
+        q2['query'].run = AsyncMock(return_value=(False, 0))
+        await self.monitor.scan()
+        res, msg = await self.monitor.get_snapshot(0)
+        self.assertTrue(res['full'])
+        self.assertEqual(res['queries'].keys(), self.monitor.queries.keys())
+        self.assertTrue(res['queries'][q1['uid']]['is_new'])
+        rev = res['revision']
+        res, msg = await self.monitor.get_snapshot(rev)
+        self.assertEqual(res['revision'], rev+1)  # new matches were reported
+        self.assertFalse(res['queries'][q1['uid']]['is_new'])
+        rev = res['revision']
+        await self.edit_query({'uid':q1['uid'], 'interval':30})
+        await self.monitor.delete_query(q2['uid'])
+        await self.monitor.scan()
+        res, msg = await self.monitor.get_snapshot(rev)
+        self.assertFalse(res['full'])
+        self.assertEqual(list(res['queries']), [q1['uid']])
+        self.assertEqual(res['queries'][q1['uid']]['interval'], 30)
+        self.assertEqual(res['removed'], [q2['uid']])
+        res, msg = await self.monitor.get_snapshot(res['revision'])
+        self.assertEqual((res['queries'], res['removed']), ({}, []))
+        res, msg = await self.monitor.get_snapshot(res['revision']+1)
+        self.assertTrue(res['full'])
+        with patch.dict(config.config, dashboard_tombstones='0'):
+            await self.monitor.delete_query(q1['uid'])
+            await self.monitor.scan()
+        res, msg = await self.monitor.get_snapshot(rev)
+        self.assertTrue(res['full'])
+        self.assertNotIn(q1['uid'], res['queries'])
+
+
+    async def test_get_revision(self):
+        '''a change of the host's state bumps the revision, other hosts don't'''
+        await self.add_query(dict(url='https://down.com/1', interval=15, sequence='test_3', alias='rev_1'))
+        q = await self.get_query_by_alias('rev_1')
+        await self.monitor.get_snapshot()
+        rev, msg = await self.monitor.get_revision()
+        host_breakers.record('https://other.com', True)
+        self.assertEqual((await self.monitor.get_revision())[0], rev)
+        with patch.dict(config.config, breaker_threshold='1'):
+            host_breakers.record(q['url'], False)
+        rev2, msg = await self.monitor.get_revision()
+        self.assertGreater(rev2, rev)
+        res, msg = await self.monitor.get_snapshot(rev)
+        self.assertTrue(res['queries'][q['uid']]['host_status'].startswith('Backoff'))
+
+
+    async def test_wait_for_update(self):
+        '''subscribers are woken up by a new revision of the snapshot'''
+        rev = self.monitor.revision
+        res, msg = await self.monitor.wait_for_update(rev, 0.01)
+        self.assertFalse(res)
+        waiter = asyncio.ensure_future(self.monitor.wait_for_update(rev, 5))
+        await asyncio.sleep(0)
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='wait_1'))
+        q = await self.get_query_by_alias('wait_1')
+        q['query'].run = AsyncMock(return_value=(False, 0))
+        await self.monitor.scan()
+        res, msg = await asyncio.wait_for(waiter, 1)
+        self.assertTrue(res)
+        self.assertGreater(self.monitor.revision, rev)
+        res, msg = await self.monitor.wait_for_update(rev, 5)
+        self.assertTrue(res)
+
+
+    async def test_snapshot_reuses_serialized_queries(self):
+        '''queries are serialized again only when they change'''
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='frag_1'))
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='frag_2'))
+        q1, q2 = await self.get_query_by_alias('frag_1'), await self.get_query_by_alias('frag_2')
+        q1['query'].run = AsyncMock(return_value=(True, 0))
+        q2['query'].run = AsyncMock(return_value=(False, 0))
+        await self.monitor.scan()
+        res, msg = await self.monitor.get_all_queries()
+        self.assertIs(res[q2['uid']], self.monitor.snapshot[q2['uid']])
+        self.assertNotIn('query', res[q1['uid']])
+        self.assertIn('query', q1)
+        with patch('server.monitor.serialize') as ser:
+            await self.monitor.get_all_queries()
+            ser.assert_not_called()
+            await self.edit_query({'uid':q1['uid'], 'interval':30})
+            await self.monitor.get_all_queries()
+            ser.assert_called_once_with(q1)
+
+
+    async def test_scan_rekey_on_edit_and_delete(self):
+        '''edited queries are re-keyed, deleted ones are dropped from the schedule'''
+        await self.add_query(dict(url='localhost_3s', interval=15, sequence='test_3', alias='rekey_1', status=0, last_run=datetime.now()))
+        q = await self.get_query_by_alias('rekey_1')
+        self.assertEqual(self.monitor.schedule.pop_due(datetime.now()), [])
+        await self.edit_query(dict(uid=q['uid'], last_run=datetime(2023,1,1)))
+        self.assertIn(q['uid'], self.monitor.schedule)
+        self.assertLessEqual(self.monitor.schedule.peek(), datetime.now())
+        await self.monitor.delete_query(q['uid'])
+        self.assertNotIn(q['uid'], self.monitor.schedule)
+
 
     async def test_should_run_cooldown(self):
         '''Check if cooldown is respected'''
@@ -571,6 +868,22 @@ class Test_Monitor(IsolatedAsyncioTestCase):
         self.assertEqual(self.monitor.warnings, set())
         public_funcs.remove('scan')
 
+        s, msg = await self.monitor.get_snapshot()
+        self.assertEqual(self.monitor.warnings, set())
+        public_funcs.remove('get_snapshot')
+
+        s, msg = await self.monitor.get_all_queries()
+        self.assertEqual(self.monitor.warnings, set())
+        public_funcs.remove('get_all_queries')
+
+        s, msg = await self.monitor.wait_for_update(0)
+        self.assertEqual(self.monitor.warnings, set())
+        public_funcs.remove('wait_for_update')
+
+        s, msg = await self.monitor.get_revision()
+        self.assertEqual(self.monitor.warnings, set())
+        public_funcs.remove('get_revision')
+
         s, msg = await self.monitor.populate()
         self.assertEqual(self.monitor.warnings, set())
         public_funcs.remove('populate')
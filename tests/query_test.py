@@ -1,71 +1,578 @@
+import asyncio
+import gzip
+import zlib
 import logging
 import os
-from unittest import TestCase
-from unittest.mock import Mock, MagicMock, AsyncMock
+import aiohttp
+from unittest import TestCase, IsolatedAsyncioTestCase, skipUnless
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
 
 CWD = os.path.dirname(os.path.abspath(__file__))
 
-import requests
-requests.get = Mock()
+import gc
+import re
+import timeit
+import warnings
+import server.query
+import server.fetch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from server.fetch import fetcher, Fetcher, Page, CachingResolver, SlicedDecompressor
+from server.http2 import HTTP2
+from server.retries import retry_budget
+from server.matcher import Matcher, StreamMatcher
+fetcher.get = AsyncMock()
 
 from . import Query
 
-class fake_response:
-    def __init__(self, text) -> None:
-        self.text = text
 
+def streamed_get(body:str, chunk_size:int=4):
+    '''fake fetcher.get that passes the body to the consumer in chunks'''
+    async def get(url, cookies=None, headers=None, timeout=None, consume=None):
+        for i in range(0, len(body), chunk_size):
+            if await consume(body[i:i+chunk_size], False):
+                return Page(200, {}, '', b'', False)
+        await consume('', True)
+        return Page(200, {}, '', b'')
+    return AsyncMock(side_effect=get)
 
-class Test_Query(TestCase):
+
+class Test_Query(IsolatedAsyncioTestCase):
 
     def setUp(self) -> None:
+        no_backoff = patch.dict(server.query.config.config, retry_backoff='0')
+        no_backoff.start()
+        self.addCleanup(no_backoff.stop)
+        retry_budget.reset()
         return super().setUp()
 
-    
-    def test_run_single_match(self):
-        data = fake_response('<head></head><body><div><h1>Hello, World</h1><p>blob</p></div></body>')
-        requests.get = Mock(return_value=data)
+
+    async def test_run_single_match(self):
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<head></head><body><div><h1>Hello, World</h1><p>blob</p></div></body>'))
         q = Query(url=None, sequence='world')
         q.do_dump_page_content = False
-        res, s = q.run()
+        res, s = await q.run()
         self.assertEqual(s, 0)
         self.assertTrue(res)
 
-    
-    def test_run_multiple_match(self):
-        data = fake_response('<div><h1>Hello, World</h1><p>world</p></div>')
-        requests.get = Mock(return_value=data)
+
+    async def test_run_multiple_match(self):
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<div><h1>Hello, World</h1><p>world</p></div>'))
         q = Query(url=None, sequence='world', min_matches=3)
         q.do_dump_page_content = False
-        res, s = q.run()
+        res, s = await q.run()
         self.assertFalse(res)
         self.assertEqual(s, 0)
 
-    
-    def test_run_access_denied(self):
-        data = fake_response('<div><h1>Hello</h1><p>Permission denied</p></div>')
-        requests.get = Mock(return_value=data)
+
+    async def test_run_access_denied(self):
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<div><h1>Hello</h1><p>Permission denied</p></div>'))
         q = Query(url=None, sequence='world')
         q.do_dump_page_content = False
-        res, s = q.run()
+        res, s = await q.run()
         self.assertFalse(res)
         self.assertEqual(s, 1)
 
 
-    def test_run_connection_lost(self):
-        data = fake_response('<div><h1>Hello</h1><p></p></div>')
-        requests.get = Mock(side_effect=requests.exceptions.ConnectionError)
+    async def test_run_connection_lost(self):
+        fetcher.get = AsyncMock(side_effect=aiohttp.ClientConnectionError)
         q = Query(url=None, sequence='world')
         q.do_dump_page_content = False
-        res, s = q.run()
+        res, s = await q.run()
         self.assertFalse(res)
         self.assertEqual(s, 2)
 
-    
-    def test_multiple_regex(self):
-        data = fake_response('<div><h1>cbt-1c9</h1><p>dam1cs</p></div>')
-        requests.get = Mock(return_value=data)
+
+    async def test_retry_transient_errors(self):
+        '''connection resets and server errors are retried up to retry_attempts'''
+        fetcher.get = AsyncMock(side_effect=[aiohttp.ServerDisconnectedError(), Page(503, {}, ''), Page(200, {}, '<p>world</p>')])
+        q = Query(url=None, sequence='world')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(q.retries, 2)
+        fetcher.get = AsyncMock(side_effect=aiohttp.ServerDisconnectedError())
+        res, s = await q.run()
+        self.assertEqual(s, 2)
+        self.assertEqual(fetcher.get.call_count, 3)
+        self.assertEqual(q.stats['retries'], 4)
+
+
+    async def test_retry_budget(self):
+        '''retries stop once the budget of the scan is spent'''
+        with patch.dict(server.query.config.config, retry_budget='1'):
+            retry_budget.reset()
+        fetcher.get = AsyncMock(side_effect=aiohttp.ServerDisconnectedError())
+        q = Query(url=None, sequence='world')
+        res, s = await q.run()
+        res, s = await q.run()
+        self.assertEqual(fetcher.get.call_count, 3)
+        self.assertEqual(q.retries, 0)
+
+
+    async def test_no_retry_on_timeout(self):
+        fetcher.get = AsyncMock(side_effect=aiohttp.ServerTimeoutError())
+        q = Query(url=None, sequence='world')
+        res, s = await q.run()
+        self.assertEqual(s, 3)
+        self.assertEqual(fetcher.get.call_count, 1)
+
+
+    async def test_retry_streamed(self):
+        '''matches of a failed attempt are not counted'''
+        get = streamed_get('world world')
+        async def flaky(*args, **kwargs):
+            page = await get(*args, **kwargs)
+            if get.call_count == 1: raise aiohttp.ClientPayloadError()
+            return page
+        fetcher.get = AsyncMock(side_effect=flaky)
+        q = Query(url=None, sequence='world', min_matches=3, parser='raw')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertEqual(q.retries, 1)
+        self.assertEqual(q.counts, [2])
+
+
+    async def test_run_timed_out(self):
+        fetcher.get = AsyncMock(side_effect=aiohttp.ServerTimeoutError)
+        q = Query(url=None, sequence='world', read_timeout=5)
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertFalse(res)
+        self.assertEqual(s, 3)
+        self.assertEqual(fetcher.get.call_args.kwargs['timeout'].sock_read, 5)
+
+
+    async def test_multiple_regex(self):
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<div><h1>cbt-1c9</h1><p>dam1cs</p></div>'))
         q = Query(url=None, sequence='dam\w+\&cbt-(1|c9)')
         q.do_dump_page_content = False
-        res, s = q.run()
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(s, 0)
+
+
+    async def test_raw_parser(self):
+        '''match on the decoded body without BeautifulSoup, case-insensitively'''
+        fetcher.get = streamed_get('<div><h1>Hello, WORLD</h1><p>world</p></div>')
+        q = Query(url=None, sequence='world', min_matches=2, parser='raw')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(s, 0)
+
+
+    async def test_raw_parser_early_exit(self):
+        '''stop reading the body once min_matches is reached'''
+        fetcher.get = streamed_get('world world' + 'x'*2000, 64)
+        q = Query(url=None, sequence='world', min_matches=2, parser='raw')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(q.stats['early_exit'], 1)
+        q = Query(url=None, sequence='world', min_matches=3, parser='raw')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertFalse(res)
+        self.assertEqual(q.stats['early_exit'], 0)
+
+
+    async def test_unavailable_parser(self):
+        '''fall back to html.parser if the parser is not available'''
+        q = Query(url=None, sequence='world', parser='xyz')
+        self.assertEqual(q.parser, 'html.parser')
+
+
+    async def test_conditional_get_not_modified(self):
+        '''send validators of the last page and reuse its result on 304'''
+        fetcher.get = AsyncMock(return_value=Page(200, {'ETag': '"abc"', 'Last-Modified': 'Mon, 01 May 2023 10:00:00 GMT'}, '<p>world</p>'))
+        q = Query(url=None, sequence='world')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(q.validators, {'If-None-Match': '"abc"', 'If-Modified-Since': 'Mon, 01 May 2023 10:00:00 GMT'})
+        fetcher.get = AsyncMock(return_value=Page(304, {}))
+        q._match = Mock()
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertEqual(s, 0)
+        q._match.assert_not_called()
+        self.assertEqual(fetcher.get.call_args.kwargs['headers']['If-None-Match'], '"abc"')
+        self.assertIn('User-Agent', fetcher.get.call_args.kwargs['headers'])
+
+
+    async def test_unchanged_content_skips_matching(self):
+        '''reuse the last match count if the page digest did not change'''
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<p>world</p>', b'digest-1'))
+        q = Query(url=None, sequence='world')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertTrue(res)
+        self.assertIsNone(q.changed)
+        q._match = Mock()
+        res, s = await q.run()
+        self.assertTrue(res)
+        q._match.assert_not_called()
+        self.assertFalse(q.changed)
+        self.assertEqual(q.stats, dict(runs=2, parsed=1, not_modified=0, unchanged=1, streamed=0, early_exit=0, retries=0))
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<p>hello</p>', b'digest-2'))
+        q._match = Mock(return_value=(0, 0))
+        res, s = await q.run()
+        self.assertFalse(res)
+        q._match.assert_called_once()
+        self.assertTrue(q.changed)
+
+
+    async def test_matcher_rebuilt_on_captcha_reload(self):
+        '''captcha keywords reloaded with the config are picked up by existing queries'''
+        fetcher.get = AsyncMock(return_value=Page(200, {}, '<p>Please solve the puzzle</p>'))
+        q = Query(url=None, sequence='world')
+        q.do_dump_page_content = False
+        res, s = await q.run()
+        self.assertEqual(s, 0)
+        kws = server.query.captcha_kw
+        server.query.captcha_kw = {'solve the puzzle'}
+        try:
+            fetcher.get = AsyncMock(return_value=Page(200, {}, '<p>Please solve the puzzle!</p>'))
+            res, s = await q.run()
+        finally:
+            server.query.captcha_kw = kws
+        self.assertEqual(s, 1)
+
+
+    async def test_close_session_keeps_fetcher(self):
+        '''the shared session is not closed when a Query is edited or removed'''
+        session = fetcher._get_session()
+        q = Query(url=None, sequence='world')
+        try:
+            await q.close_session()
+            self.assertIs(fetcher._get_session(), session)
+            self.assertFalse(session.closed)
+        finally:
+            await fetcher.close()
+
+
+class Test_Matcher(TestCase):
+
+    def test_counts(self):
+        '''count every sequence, keywords are detected only if nothing matched'''
+        m = Matcher([re.compile('dam\\w+'), re.compile('cbt-(1|c9)')], {'captcha', '403 forbidden'})
+        self.assertEqual(m.match('dam1cs cbt-1c9 cbt-c9 captcha damx'), ([2, 2], set()))
+        self.assertEqual(m.match('please solve the captcha'), ([0, 0], {'captcha'}))
+
+
+    def test_overlapping_sequences(self):
+        '''sequences don't take matches from each other'''
+        m = Matcher([re.compile('abc'), re.compile('bc')], {'captcha'})
+        self.assertEqual(m.match('abc abc'), ([2, 2], set()))
+
+
+    def test_keyword_containing_sequence(self):
+        '''a sequence is counted even if it's a part of a captcha keyword'''
+        m = Matcher([re.compile('forbidden')], {'403 forbidden'})
+        self.assertEqual(m.match('error 403 forbidden'), ([1], set()))
+        m = Matcher([re.compile('forbidden!')], {'403 forbidden'})
+        self.assertEqual(m.match('error 403 forbidden'), ([0], {'403 forbidden'}))
+
+
+    def test_overlapping_keywords(self):
+        '''keywords overlapping or starting with each other are all detected'''
+        m = Matcher([re.compile('x')], {'captcha', 'captcha required', 'required access'})
+        self.assertEqual(m.match('captcha required access')[1], {'captcha', 'captcha required', 'required access'})
+
+
+    def test_backreferences(self):
+        '''backreferences refer to the groups of their own sequence'''
+        m = Matcher([re.compile('b'), re.compile('(a)\\1')], {'captcha'})
+        self.assertEqual(m.match('aa b aab captcha'), ([2, 2], set()))
+
+
+    def test_empty_keyword_ignored(self):
+        '''trailing separator in captcha_kw does not flag every page'''
+        m = Matcher([re.compile('x')], {'', 'captcha'})
+        self.assertEqual(m.match('nothing here'), ([0], set()))
+
+
+    def test_stream_straddling_chunks(self):
+        '''matches split between chunks are counted once'''
+        text = 'dam1cs cbt-1c9 cbt-c9 captcha damx'
+        m = Matcher([re.compile('dam\\w+'), re.compile('cbt-(1|c9)')], {'captcha'})
+        for overlap in (8, 20):
+            for size in (1, 3, 7):
+                stream = StreamMatcher(m, 100, overlap)
+                for i in range(0, len(text), size):
+                    stream.feed(text[i:i+size])
+                stream.feed('', final=True)
+                self.assertEqual((stream.counts, stream.matched_kws), m.match(text))
+
+
+    def test_stream_overlapping(self):
+        '''overlapping sequences and keywords are streamed the same way'''
+        text = 'aa b aab captcha required abc forbidden 403 forbidden'
+        m = Matcher([re.compile('(a)\\1'), re.compile('b'), re.compile('abc'), re.compile('bc'), re.compile('forbidden')], 
+                    {'captcha', 'captcha required', '403 forbidden'})
+        stream = StreamMatcher(m, 100, 20)
+        for c in text: stream.feed(c)
+        stream.feed('', final=True)
+        self.assertEqual((stream.counts, stream.matched_kws), m.match(text))
+        self.assertEqual(stream.counts, [2, 5, 1, 1, 2])
+
+
+    def test_stream_keywords(self):
+        '''keywords straddling chunks are detected while nothing matched'''
+        text = 'captcha required, 403 forbidden'
+        m = Matcher([re.compile('x')], {'captcha', 'captcha required', '403 forbidden'})
+        for size in (1, 3, 7):
+            stream = StreamMatcher(m, 100, 20)
+            for i in range(0, len(text), size):
+                stream.feed(text[i:i+size])
+            stream.feed('', final=True)
+            self.assertEqual(stream.matched_kws, {'captcha', 'captcha required', '403 forbidden'})
+
+
+    def test_keywords_speed(self):
+        '''the keyword scan is no slower than looking for each keyword in the page'''
+        kws = {'captcha-delivery', 'strona wymaga zalogowania', '403 forbidden'}
+        text = ' '.join(f'<p class="item-{i}">word {i*7919 % 10007}</p>' for i in range(20_000))
+        m = Matcher([re.compile('x{3}')], kws)
+        baseline = lambda: (len(re.compile('x{3}').findall(text)), {kw for kw in kws if kw in text})
+        self.assertEqual(m.match(text), ([0], set()))
+        times = [(timeit.timeit(lambda: m.match(text), number=3), timeit.timeit(baseline, number=3)) for _ in range(10)]
+        self.assertLess(min(t for t, _ in times), 2 * min(b for _, b in times))
+
+
+class Test_Fetcher(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.body = b'abc' * 100_000
+        app = web.Application()
+        app.router.add_get('/', self.handler, allow_head=False)
+        app.router.add_head('/', self.head_handler)
+        app.router.add_get('/compressed/{encoding}', self.compressed_handler)
+        app.router.add_get('/flaky', self.flaky_handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.fetcher = Fetcher()
+        self.requests = 0
+        self.heads = 0
+
+
+    async def handler(self, request):
+        self.requests += 1
+        await asyncio.sleep(0.01)
+        return web.Response(body=self.body, content_type='text/plain')
+
+
+    async def flaky_handler(self, request):
+        '''fails with 503 on the first request'''
+        self.requests += 1
+        if self.requests == 1:
+            return web.Response(status=503, text='unavailable')
+        return web.Response(text='<p>world</p>', content_type='text/html')
+
+
+    async def head_handler(self, request):
+        self.heads += 1
+        return web.Response()
+
+
+    async def compressed_handler(self, request):
+        self.accept_encoding = request.headers.get('Accept-Encoding')
+        encoding = request.match_info['encoding']
+        if encoding == 'gzip':
+            body = gzip.compress(self.body)
+        else:
+            c = zlib.compressobj(wbits=-zlib.MAX_WBITS)  # raw deflate, as sent by some servers
+            body = c.compress(self.body) + c.flush()
+        return web.Response(body=body, content_type='text/plain', headers={'Content-Encoding': encoding})
+
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        await self.server.close()
+
+
+    async def test_server_error_retried(self):
+        '''server errors are not cached, so the retry reaches the server'''
+        with patch.object(server.query, 'fetcher', self.fetcher), patch.dict(server.query.config.config, retry_backoff='0'):
+            retry_budget.reset()
+            q = Query(url=str(self.server.make_url('/flaky')), sequence='world')
+            q.do_dump_page_content = False
+            res, s = await q.run()
         self.assertTrue(res)
         self.assertEqual(s, 0)
+        self.assertEqual(q.retries, 1)
+        self.assertEqual(self.requests, 2)
+
+
+    async def test_close_session_cancels_run(self):
+        '''closing a Query cancels its run, a download shared with another Query keeps going'''
+        url = str(self.server.make_url('/'))
+        with patch.object(server.query, 'fetcher', self.fetcher):
+            closed, other = Query(url=url, sequence='abc'), Query(url=url, sequence='abc')
+            closed.do_dump_page_content = other.do_dump_page_content = False
+            tasks = [asyncio.ensure_future(closed.run()), asyncio.ensure_future(other.run())]
+            await asyncio.sleep(0.005)
+            self.assertIs(closed.task, tasks[0])
+            await closed.close_session()
+            res = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertIsInstance(res[0], asyncio.CancelledError)
+        self.assertEqual(res[1], (True, 0))
+        self.assertIsNone(closed.task)
+        self.assertEqual(self.requests, 1)
+
+
+    async def test_max_body_size(self):
+        '''body is truncated at max_body_size'''
+        with patch.dict(server.fetch.config.config, max_body_size='1000'):
+            page = await Fetcher.get(self.fetcher, str(self.server.make_url('/')))
+        self.assertEqual(len(page.text), 1000)
+        self.assertFalse(page.complete)
+
+
+    async def test_max_body_size_compressed(self):
+        '''a small compressed chunk is not decompressed past max_body_size'''
+        bomb = gzip.compress(b'\0' * 50_000_000)
+        async def chunks(): yield bomb
+        body = [chunk async for chunk in self.fetcher._decompress(chunks(), 'gzip', 1000)]
+        self.assertEqual(len(b''.join(body)), 1001)
+        self.assertEqual(self.fetcher.stats['body_bytes'], 1001)
+        fed, zlib_obj = [], zlib.decompressobj(16+zlib.MAX_WBITS)
+        sliced = SlicedDecompressor(Mock(decompress=lambda data: fed.append(data) or zlib_obj.decompress(data)))
+        self.assertEqual(len(sliced.decompress(bomb, 1000)), 1000)
+        self.assertEqual(len(b''.join(fed)), SlicedDecompressor.SLICE)  # decompressors without an output limit
+
+
+    async def test_consume_stops_reading(self):
+        '''reading stops once the consumer returns True'''
+        chunks = []
+        async def consume(text, final):
+            chunks.append(text)
+            return True
+        page = await Fetcher.get(self.fetcher, str(self.server.make_url('/')), consume=consume)
+        self.assertEqual(len(chunks), 1)
+        self.assertFalse(page.complete)
+        page = await Fetcher.get(self.fetcher, str(self.server.make_url('/')))
+        self.assertEqual(page.text, self.body.decode())
+        self.assertTrue(page.complete)
+
+
+    async def test_coalesce_concurrent_requests(self):
+        '''concurrent requests for the same page share one download'''
+        url = str(self.server.make_url('/'))
+        pages = await asyncio.gather(*(Fetcher.get(self.fetcher, url, cookies={'a': '1'}) for _ in range(3)))
+        self.assertEqual(self.requests, 1)
+        self.assertTrue(all(p is pages[0] for p in pages))
+        await Fetcher.get(self.fetcher, url, cookies={'a': '2'})
+        self.assertEqual(self.requests, 2)
+        self.assertEqual({k: self.fetcher.stats[k] for k in ('downloads', 'coalesced', 'cached')}, dict(downloads=2, coalesced=2, cached=0))
+
+
+    async def test_shared_cache(self):
+        '''pages are served from cache until fetch_cache_ttl expires'''
+        url = str(self.server.make_url('/'))
+        page = await Fetcher.get(self.fetcher, url)
+        chunks = []
+        async def consume(text, final):
+            chunks.append((text, final))
+            return False
+        await Fetcher.get(self.fetcher, url, consume=consume)
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(chunks, [(page.text, True)])
+        with patch.dict(server.fetch.config.config, fetch_cache_ttl='0'):
+            self.fetcher.cache.clear()
+            await Fetcher.get(self.fetcher, url)
+            await Fetcher.get(self.fetcher, url)
+        self.assertEqual(self.requests, 3)
+
+
+    async def test_decompress(self):
+        '''compressed bodies are negotiated and decompressed while streaming'''
+        for encoding in ('gzip', 'deflate'):
+            chunks = []
+            async def consume(text, final):
+                chunks.append(text)
+                return False
+            page = await Fetcher.get(self.fetcher, str(self.server.make_url(f'/compressed/{encoding}')), consume=consume)
+            self.assertEqual(''.join(chunks), self.body.decode())
+            self.assertIn('gzip', self.accept_encoding)
+        self.assertLess(self.fetcher.stats['received_bytes']*10, self.fetcher.stats['body_bytes'])
+
+
+    async def test_resolver_cache(self):
+        '''hosts are resolved once per dns_cache_ttl'''
+        resolver = CachingResolver()
+        resolver.resolver = Mock(resolve=AsyncMock(return_value=[{'host': '127.0.0.1'}]))
+        await asyncio.gather(*(resolver.resolve('example.com', 443) for _ in range(3)))
+        await resolver.resolve('example.com', 443)
+        self.assertEqual(resolver.resolver.resolve.call_count, 1)
+        with patch.dict(server.fetch.config.config, dns_cache_ttl='0'):
+            resolver.cache.clear()
+            await resolver.resolve('example.com', 443)
+            await resolver.resolve('example.com', 443)
+        self.assertEqual(resolver.resolver.resolve.call_count, 3)
+
+
+    async def test_prewarm(self):
+        '''connections are opened once per keep-alive period if enabled'''
+        url = str(self.server.make_url('/'))
+        await Fetcher.prewarm(self.fetcher, {url})
+        self.assertEqual(self.heads, 0)
+        self.assertIn(('127.0.0.1', self.server.port, 0), self.fetcher.resolver.cache)
+        with patch.dict(server.fetch.config.config, prewarm_connections='true'):
+            await Fetcher.prewarm(self.fetcher, {url, url+'a'})
+            await Fetcher.prewarm(self.fetcher, {url})
+        self.assertEqual(self.heads, 1)
+
+
+    async def test_prewarm_same_host(self):
+        '''urls on one host are resolved or connected to once'''
+        urls = {'https://example.com/a', 'https://example.com/b', 'https://example.com/c'}
+        self.fetcher._get_session()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with patch.object(self.fetcher.resolver, 'resolve', AsyncMock()) as resolve:
+                await Fetcher.prewarm(self.fetcher, urls)
+            with patch.object(self.fetcher, '_open_connection', AsyncMock()) as connect, \
+                 patch.dict(server.fetch.config.config, prewarm_connections='true'):
+                await Fetcher.prewarm(self.fetcher, urls)
+            gc.collect()
+        self.assertEqual(resolve.call_count, 1)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual([w for w in caught if issubclass(w.category, RuntimeWarning)], [])
+
+
+    @skipUnless(HTTP2, 'httpx[http2] is not installed')
+    async def test_http2_discovery(self):
+        '''origins are requested over HTTP/2 until they negotiate HTTP/1.1'''
+        import httpx
+        versions = {'h2.com': b'HTTP/2', 'h1.com': b'HTTP/1.1'}
+        def handler(request):
+            return httpx.Response(200, stream=httpx.ByteStream(gzip.compress(b'hello')), headers={'Content-Encoding': 'gzip'},
+                                  extensions={'http_version': versions[request.url.host]})
+        self.fetcher.http2.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch.dict(server.fetch.config.config, http2='true'):
+            for _ in range(2):
+                page = await Fetcher.get(self.fetcher, 'https://h2.com/a')
+                self.assertEqual(page.text, 'hello')
+            await Fetcher.get(self.fetcher, 'https://h1.com/a')
+            self.assertTrue(self.fetcher._use_http2('https://h2.com/b'))
+            self.assertFalse(self.fetcher._use_http2('https://h1.com/b'))
+            self.assertFalse(self.fetcher._use_http2(str(self.server.make_url('/'))))
+
+
+    @skipUnless(HTTP2, 'httpx[http2] is not installed')
+    async def test_http2_no_cookie_jar(self):
+        '''Set-Cookie of one response is not sent with requests of other Queries'''
+        import httpx
+        sent = []
+        def handler(request):
+            sent.append(request.headers.get('Cookie'))
+            return httpx.Response(200, stream=httpx.ByteStream(b'hello'), headers={'Set-Cookie': 'session=abc; Path=/'},
+                                  extensions={'http_version': b'HTTP/2'})
+        with patch.dict(server.fetch.config.config, http2='true'):
+            self.fetcher.http2._get_client()._transport = httpx.MockTransport(handler)
+            await Fetcher.get(self.fetcher, 'https://h2.com/a')
+            await Fetcher.get(self.fetcher, 'https://h2.com/b')
+            await Fetcher.get(self.fetcher, 'https://h2.com/c', cookies={'user': '1'})
+        self.assertEqual(sent, [None, None, 'user=1'])
@@ -0,0 +1,69 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+
+from server.scheduler import Scheduler
+
+
+class Test_Scheduler(TestCase):
+
+    def setUp(self) -> None:
+        self.schedule = Scheduler()
+        self.now = datetime(2023, 5, 1, 12, 0)
+        return super().setUp()
+
+
+    def test_pop_due_only(self):
+        '''only entries due at the given time are returned, earliest first'''
+        self.schedule.push('b', self.now - timedelta(minutes=1))
+        self.schedule.push('c', self.now + timedelta(minutes=5))
+        self.schedule.push('a', self.now - timedelta(minutes=2))
+        self.assertEqual(self.schedule.pop_due(self.now), ['a', 'b'])
+        self.assertEqual(len(self.schedule), 1)
+        self.assertEqual(self.schedule.peek(), self.now + timedelta(minutes=5))
+
+
+    def test_rekey(self):
+        '''pushing an existing uid replaces its previous entry'''
+        self.schedule.push('a', self.now - timedelta(minutes=1))
+        self.schedule.push('a', self.now + timedelta(minutes=1))
+        self.assertEqual(self.schedule.pop_due(self.now), [])
+        self.assertEqual(self.schedule.pop_due(self.now + timedelta(minutes=1)), ['a'])
+        self.assertNotIn('a', self.schedule)
+
+
+    def test_remove(self):
+        '''removed and never-due entries are not returned'''
+        self.schedule.push('a', self.now)
+        self.schedule.push('b', self.now)
+        self.schedule.remove('a')
+        self.schedule.push('b', None)
+        self.assertEqual(self.schedule.pop_due(self.now), [])
+        self.assertIsNone(self.schedule.peek())
+
+
+    def test_compact(self):
+        '''heap does not grow unbounded when entries are re-keyed repeatedly'''
+        for i in range(1000):
+            self.schedule.push('a', self.now + timedelta(seconds=i))
+        self.assertLess(len(self.schedule.heap), 100)
+        self.assertEqual(self.schedule.pop_due(self.now + timedelta(hours=1)), ['a'])
+
+
+    def test_upcoming(self):
+        '''entries due before the given time are listed without being removed'''
+        self.schedule.push('a', self.now + timedelta(seconds=3))
+        self.schedule.push('b', self.now + timedelta(minutes=5))
+        self.assertEqual(self.schedule.upcoming(self.now + timedelta(seconds=5)), ['a'])
+        self.assertIn('a', self.schedule)
+
+
+    def test_upcoming_order(self):
+        '''upcoming uids are listed in due order and removed entries are skipped'''
+        for i in range(50):
+            self.schedule.push(i, self.now + timedelta(seconds=(i*7) % 50))
+        for i in range(0, 50, 3):
+            self.schedule.remove(i)
+        expected = sorted((i for i in range(50) if i % 3 and (i*7) % 50 <= 20), key=lambda i: (i*7) % 50)
+        self.assertEqual(self.schedule.upcoming(self.now + timedelta(seconds=20)), expected)
+        self.assertEqual(self.schedule.upcoming(self.now - timedelta(seconds=1)), [])
+        self.assertEqual(len(self.schedule), 33)
@@ -1,5 +1,7 @@
+import asyncio
+import json
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import Mock, MagicMock, AsyncMock
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
 from datetime import datetime
 from aiohttp import web
 
@@ -8,16 +10,17 @@ import server.query
 server.query.Query = fake_query
 
 from . import fake_monitor
-from server.users import require_login
+from server.users import auth_middleware
 from common import *
 from server.users import UserManager
 from server.utils import config
+from server.scheduler import Scheduler
+import server.users
 
 
 login_count = 0
 
 
-@require_login
 async def _require_login(d:dict):
     d['login'] = 'conducted'
     global login_count
@@ -25,10 +28,14 @@ async def _require_login(d:dict):
     return d
 
 class fake_webrequest(dict):
-    def __init__(self, data:dict):
-        self.data = data
-    async def json(self):
-        return self.data
+    def __init__(self, data, path:str='/get_dashboard', method:str='POST'):
+        self.body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.path = path
+        self.method = method
+        self.reads = 0
+    async def read(self):
+        self.reads += 1
+        return self.body
 
 
 
@@ -169,6 +176,70 @@ class Test_UserManager(IsolatedAsyncioTestCase):
         self.assertEqual(res, {})
 
 
+    async def test_get_dashboard(self):
+        '''dashboard is served from the monitor snapshot without scanning'''
+        fm = fake_monitor('testuser')
+        fm.scan = AsyncMock()
+        self.usermanager.sessions['testuser'] = dict(monitor=fm)
+        res, msg = await self.usermanager.get_dashboard('testuser')
+        self.assertEqual(res, {})
+        fm.scan.assert_not_called()
+        fm.get_snapshot = AsyncMock(return_value=(dict(revision=5, full=False, queries={}, removed=[]), ''))
+        res, msg = await self.usermanager.get_dashboard('testuser', 3)
+        fm.get_snapshot.assert_called_once_with(3)
+
+
+    async def test_get_dashboard_revision(self):
+        fm = fake_monitor('testuser')
+        fm.revision = 42
+        self.usermanager.sessions['testuser'] = dict(monitor=fm)
+        self.assertEqual(await self.usermanager.get_dashboard_revision('testuser'), 42)
+
+
+    async def test_watch_dashboard(self):
+        '''deltas are pushed only when there are changes, until the user logs out'''
+        fm = fake_monitor('testuser')
+        deltas = [dict(revision=1, full=True, queries={}, removed=[]),
+                  dict(revision=1, full=False, queries={}, removed=[]),
+                  dict(revision=2, full=False, queries={'abcuid':{}}, removed=[])]
+        fm.get_snapshot = AsyncMock(side_effect=[(d, '') for d in deltas])
+        fm.wait_for_update = AsyncMock(return_value=(True, ''))
+        self.usermanager.sessions['testuser'] = dict(monitor=fm)
+        res = list()
+        async for delta in self.usermanager.watch_dashboard('testuser', 0):
+            res.append(delta)
+            if len(res) == 2: del self.usermanager.sessions['testuser']
+        self.assertEqual(res, [deltas[0], deltas[2]])
+        self.assertEqual([c.args[0] for c in fm.get_snapshot.call_args_list], [0, 1, 1])
+
+
+    async def test_get_stats(self):
+        '''return fetch statistics per query'''
+        fm = fake_monitor('testuser')
+        fm.queries['abcuid'] = dict(alias='test', query=fake_query())
+        self.usermanager.sessions['testuser'] = dict(monitor=fm)
+        res = await self.usermanager.get_stats('testuser')
+        self.assertEqual(res['abcuid']['unchanged'], 0)
+
+
+    async def test_prewarm(self):
+        '''hosts of upcoming queries are pre-warmed in one task at a time and its failures are logged'''
+        fm = fake_monitor('testuser')
+        fm.schedule = Scheduler()
+        fm.queries['abcuid'] = dict(url='https://example.com/a')
+        fm.schedule.push('abcuid', datetime(2023,1,1))
+        prewarm = AsyncMock(side_effect=OSError('unreachable'))
+        with patch.object(server.users.fetcher, 'prewarm', prewarm), self.assertLogs('UserManager', 'ERROR') as logs:
+            self.usermanager._prewarm([fm], datetime(2023,1,2))
+            task = self.usermanager.prewarming
+            self.usermanager._prewarm([fm], datetime(2023,1,2))
+            self.assertIs(self.usermanager.prewarming, task)
+            await asyncio.gather(task, return_exceptions=True)
+            await asyncio.sleep(0)
+        prewarm.assert_called_once_with({'https://example.com/a'})
+        self.assertIn('unreachable', logs.output[0])
+
+
     async def test_edit_query_1(self):
         '''check if handled properly'''
         fm = fake_monitor('test_user')
@@ -214,30 +285,50 @@ class Test_UserManager(IsolatedAsyncioTestCase):
         self.usermanager.sessions['testuser'] = dict(monitor=fake_monitor('test_user'), token='test_token', last_active=datetime(2023,1,1))
         
         # Invalid token
-        res:web.Response = await _require_login(fake_webrequest(dict(username='test_user', token='wrong_token')))
+        res:web.Response = await auth_middleware(fake_webrequest(dict(username='test_user', token='wrong_token')), _require_login)
         self.assertIsInstance(res, web.Response)
-        res = res.body.decode()
-        self.assertEqual(res, '{"success": false, "msg": "Access Denied"}')
+        self.assertEqual(json.loads(res.body), {"success": False, "msg": "Access Denied"})
         self.assertEqual(login_count, exp_login_count, 'Protected function was called despite failed login')
         self.assertEqual(self.usermanager.sessions['testuser']['last_active'], datetime(2023,1,1))
         
         # Correct login
-        res = await _require_login(fake_webrequest(dict(username='testuser', token='test_token')))
+        req = fake_webrequest(dict(username='testuser', token='test_token', uid='abc'))
+        res = await auth_middleware(req, _require_login)
         exp_login_count+=1
         self.assertIsInstance(res, dict)
         self.assertEqual(res['login'], 'conducted')
+        self.assertEqual(res['username'], 'testuser')
+        self.assertEqual(res['data'], dict(username='testuser', token='test_token', uid='abc'))
+        self.assertEqual(req.reads, 1, 'Body should be decoded once')
         self.assertEqual(login_count, exp_login_count)
         self.assertEqual(self.usermanager.sessions['testuser']['last_active'].minute, datetime.today().minute)
         self.assertEqual(self.usermanager.sessions['testuser']['last_active'].hour, datetime.today().hour)
         
         # Unknown User
-        res:web.Response = await _require_login(fake_webrequest(dict(username='no_user', token='test_token')))
+        res:web.Response = await auth_middleware(fake_webrequest(dict(username='no_user', token='test_token')), _require_login)
         self.assertIsInstance(res, web.Response)
-        res = res.body.decode()
-        self.assertEqual(res, '{"success": false, "msg": "Access Denied"}')
+        self.assertEqual(json.loads(res.body), {"success": False, "msg": "Access Denied"})
         self.assertEqual(login_count, exp_login_count, 'Protected function was called despite failed login')
 
 
+    async def test_require_login_2(self):
+        '''public routes are not authenticated, malformed bodies are rejected'''
+        exp_login_count = login_count
+        res = await auth_middleware(fake_webrequest(dict(username='new_user', password='pass'), path='/auth'), _require_login)
+        self.assertEqual(res['data'], dict(username='new_user', password='pass'))
+        self.assertNotIn('username', res)
+        res = await auth_middleware(fake_webrequest(b'{not json', path='/get_dashboard'), _require_login)
+        self.assertEqual(res.status, 400)
+        res = await auth_middleware(fake_webrequest(b'[]', path='/get_dashboard'), _require_login)
+        self.assertEqual(json.loads(res.body)['msg'], 'Access Denied')
+        for codec in ('json', 'orjson'):
+            with patch.dict(config.config, json_codec=codec):
+                res = await auth_middleware(fake_webrequest(dict(username='x', token='y')), _require_login)
+                self.assertEqual(json.loads(res.body), {"success": False, "msg": "Access Denied"})
+                self.assertEqual(res.content_type, 'application/json')
+        self.assertEqual(login_count, exp_login_count+1)
+
+
     async def test_settings_edit(self):
         self.usermanager.sessions['testuser'] = dict(monitor=fake_monitor('test_user'), 
             token='test_token', last_active=datetime(2023,1,1), 
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+import server.query
+import server.monitor
+from server.utils import config
+from server.workers import WorkerPool, worker_pool
+
+
+class Test_WorkerPool(IsolatedAsyncioTestCase):
+
+    async def test_shared(self):
+        '''all Monitors and Queries use the same pool'''
+        self.assertIs(WorkerPool(), worker_pool)
+        self.assertIs(server.query.worker_pool, worker_pool)
+        self.assertIs(server.monitor.worker_pool, worker_pool)
+
+
+    async def test_size(self):
+        self.assertEqual(worker_pool.size, int(config['worker_pool_size']))
+        self.assertEqual(worker_pool.executor._max_workers, worker_pool.size)
+        self.assertEqual(worker_pool.user_quota, int(config['worker_user_quota']))
+
+
+    async def test_submit(self):
+        '''work runs in the pool's threads'''
+        name = await worker_pool.submit(lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith('Worker'))
+
+
+    async def test_quota(self):
+        '''a user cannot run more Queries at once than the quota, other users are not blocked'''
+        running, peak = [0], [0]
+        async def run(username:str):
+            async with worker_pool.quota(username):
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+                await asyncio.sleep(0.01)
+                running[0] -= 1
+        with patch.object(worker_pool, 'user_quota', 2), patch.dict(worker_pool.quotas, clear=True):
+            self.assertIs(worker_pool.quota('a'), worker_pool.quota('a'))
+            await asyncio.gather(*(run('a') for _ in range(5)))
+            self.assertEqual(peak[0], 2)
+            async with worker_pool.quota('a'), worker_pool.quota('a'):
+                await asyncio.wait_for(run('b'), 1)
+                self.assertTrue(worker_pool.quota('a').locked())